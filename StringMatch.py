@@ -2,9 +2,23 @@
 This program is to label the search query with the corresponding attributes from the click logs
 """
 
+import re
+import ast
 import json
+import hashlib
 import numpy as np
 import argparse
+import os
+import sys
+import mmap
+import time
+import heapq
+import random
+import bisect
+import contextlib
+import itertools
+import multiprocessing
+from collections import Counter, OrderedDict, deque
 from pyjarowinkler import distance  # pip install pyjarowinkler
 
 
@@ -24,16 +38,47 @@ def trigram(word):
     return trigram_list
 
 
-def similarity(w1, w2, algorithm, threshold):
+# the units of the numbers and their canonical forms, "65in", "65 inches" and '65"' are all "65 inch"
+UNITS = {"in": "inch", "inch": "inch", "inches": "inch", "\"": "inch", "ft": "ft", "feet": "ft", "foot": "ft",
+         "mm": "mm", "cm": "cm", "mb": "mb", "gb": "gb", "tb": "tb", "hz": "hz", "mhz": "mhz", "ghz": "ghz",
+         "mp": "mp", "w": "w", "watt": "w", "watts": "w", "mah": "mah", "oz": "oz", "lb": "lb", "lbs": "lb"}
+# the runs of letters and digits, the decimal numbers and the inch mark, the other characters separate the tokens
+TOKEN_PATTERN = re.compile(r"\d+(?:\.\d+)+|[^\W_]+|\"")
+NUMBER_PATTERN = re.compile(r"\d+(?:\.\d+)*")
+NUMBER_UNIT_PATTERN = re.compile(r"(\d+)([^\W\d_]+)")
+
+
+def normalize_tokens(text):
+    """
+    split a query or an attribute value into normalized tokens: the text is case folded, the punctuation and the
+    whitespaces separate the tokens, and a number with a unit, e.g. "65in", "65 inches" or '65"', becomes the number
+    and the canonical unit "65", "inch". a unit between two numbers is kept as it is, e.g. "2 in 1"
+    :param text: a query or an attribute value
+    :return: a list of interned tokens, no token is empty
+    """
+    raw_tokens = TOKEN_PATTERN.findall(text.casefold())
+    tokens = []
+    for index, token in enumerate(raw_tokens):
+        number_unit = NUMBER_UNIT_PATTERN.fullmatch(token)
+        if number_unit is not None and number_unit.group(2) in UNITS:
+            tokens.append(sys.intern(number_unit.group(1)))
+            tokens.append(UNITS[number_unit.group(2)])
+        elif (token in UNITS and len(tokens) > 0 and NUMBER_PATTERN.fullmatch(tokens[-1]) is not None
+              and (index + 1 == len(raw_tokens) or NUMBER_PATTERN.fullmatch(raw_tokens[index + 1]) is None)):
+            tokens.append(UNITS[token])
+        elif token != "\"":
+            tokens.append(sys.intern(token))
+    return tokens
+
+
+def similarity_score(w1, w2, algorithm):
     """
-    Computes the trigrams similarity of two input words w1 and w2
+    Computes the similarity score of two input words w1 and w2
     :param w1: the first input word
     :param w2: the second input word
     :param algorithm: the name of the algorithm to calculate the similarity
-    :param threshold: the threshold to determine whether two word are similar or not
     :return:
-            1: two words are similar
-            0: two words are not similar
+        score: the similarity score
     """
     if algorithm == "trigram":
         # lower w1 and w2
@@ -44,7 +89,695 @@ def similarity(w1, w2, algorithm, threshold):
         score = distance.get_jaro_distance(w1, w2, winkler=True, scaling=0.1)
     # for test
     # print(score)
-    return score >= threshold
+    return score
+
+
+def similarity(w1, w2, algorithm, threshold):
+    """
+    Computes the similarity of two input words w1 and w2
+    :param w1: the first input word
+    :param w2: the second input word
+    :param algorithm: the name of the algorithm to calculate the similarity
+    :param threshold: the threshold to determine whether two word are similar or not
+    :return:
+            1: two words are similar
+            0: two words are not similar
+    """
+    return similarity_score(w1, w2, algorithm) >= threshold
+
+
+class SimilarityCache(object):
+    """
+    a bounded LRU cache of the similarity scores keyed on (algorithm, w1, w2), one cache is shared by all the queries of
+    a query_tagging run and it can be saved to disk to start the next run warm
+    """
+
+    def __init__(self, max_size=1000000, score_function=None):
+        """
+        :param max_size: the maximum number of cached scores, the least recently used score is evicted first
+        :param score_function: the function computing the score of (w1, w2, algorithm) on a cache miss,
+                               similarity_score if it is None
+        """
+        self.max_size = max_size
+        self.score_function = score_function if score_function is not None else similarity_score
+        self.scores = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def score(self, w1, w2, algorithm):
+        """
+        get the similarity score of two words, it is only computed on a cache miss
+        :param w1: the first input word
+        :param w2: the second input word
+        :param algorithm: the name of the algorithm to calculate the similarity
+        :return: the similarity score
+        """
+        key = (algorithm, w1, w2)
+        score = self.scores.get(key)
+        if score is not None:
+            self.hits = self.hits + 1
+            self.scores.move_to_end(key)
+            return score
+        self.misses = self.misses + 1
+        score = self.score_function(w1, w2, algorithm)
+        self.put(key, score)
+        return score
+
+    def put(self, key, score):
+        """
+        cache a score and evict the least recently used ones beyond max_size
+        :param key: (algorithm, w1, w2)
+        :param score: the similarity score
+        """
+        if self.max_size <= 0:
+            return
+        self.scores[key] = score
+        self.scores.move_to_end(key)
+        while len(self.scores) > self.max_size:
+            self.scores.popitem(last=False)
+
+    def save(self, path):
+        """
+        write the cached scores to a json file, from the least to the most recently used
+        :param path: the path of the cache file
+        """
+        with open(path, "w") as cache_json:
+            json.dump([[algorithm, w1, w2, score] for (algorithm, w1, w2), score in self.scores.items()], cache_json)
+
+    def load(self, path):
+        """
+        read the scores saved by save, nothing is loaded if the file doesn't exist
+        :param path: the path of the cache file
+        """
+        if not os.path.exists(path):
+            return
+        with open(path) as cache_json:
+            for algorithm, w1, w2, score in json.load(cache_json):
+                self.put((algorithm, w1, w2), score)
+
+    def report(self):
+        """
+        :return: a line describing the hits and misses of the cache
+        """
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total > 0 else 0.0
+        return "Similarity cache: {} hits, {} misses, hit rate {:.2%}, {} cached scores".format(
+            self.hits, self.misses, hit_rate, len(self.scores))
+
+
+class QueryCache(object):
+    """
+    a bounded LRU cache of the labels of whole queries keyed on (query, algorithm, threshold, options, the version of
+    the click log), a changed click log has a new version so its queries never hit the labels of the old one. the
+    labels are shared with the callers and not copied, a copied set may iterate in another order and change the output,
+    so the callers must not modify them
+    """
+
+    def __init__(self, max_size=100000):
+        """
+        :param max_size: the maximum number of cached queries, the least recently used query is evicted first
+        """
+        self.max_size = max_size
+        self.tagged_queries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(query, algorithm, threshold, *options):
+        """
+        :param query: a query string, the trailing newline is not part of the key
+        :param algorithm: the name of the algorithm to calculate the similarity
+        :param threshold: the threshold to determine whether two word are similar or not
+        :param options: the version of the click log and the other arguments changing the labels
+        :return: the key of the query
+        """
+        return (query.strip("\n"), algorithm, threshold) + options
+
+    def __contains__(self, key):
+        return key in self.tagged_queries
+
+    def get(self, key):
+        """
+        :param key: the key of a query
+        :return: the cached labels of the query, None on a cache miss
+        """
+        tagged_query = self.tagged_queries.get(key)
+        if tagged_query is None:
+            self.misses = self.misses + 1
+            return None
+        self.hits = self.hits + 1
+        self.tagged_queries.move_to_end(key)
+        return tagged_query
+
+    def put(self, key, tagged_query):
+        """
+        cache the labels of a query and evict the least recently used ones beyond max_size
+        :param key: the key of the query
+        :param tagged_query: the labels of the query
+        """
+        if self.max_size <= 0:
+            return
+        self.tagged_queries[key] = tagged_query
+        self.tagged_queries.move_to_end(key)
+        while len(self.tagged_queries) > self.max_size:
+            self.tagged_queries.popitem(last=False)
+
+    def clear(self):
+        """
+        drop all the cached queries, e.g. when the click log is reloaded
+        """
+        self.tagged_queries.clear()
+
+    def report(self):
+        """
+        :return: a line describing the hits and misses of the cache
+        """
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total > 0 else 0.0
+        return "Query cache: {} hits, {} misses, hit rate {:.2%}, {} cached queries".format(
+            self.hits, self.misses, hit_rate, len(self.tagged_queries))
+
+
+class QueryProfile(object):
+    """
+    the wall time of each stage and the counters of a query, the stages are timed by laps
+    """
+
+    def __init__(self, query):
+        """
+        :param query: a query string
+        """
+        self.query = query.strip("\n")
+        self.seconds = {}
+        self.counters = {}
+        # the time spent on the values of each attribute
+        self.attributes = {}
+        self.started = time.perf_counter()
+        self.last = self.started
+        self.total_seconds = 0.0
+
+    def lap(self, stage):
+        """
+        add the time since the last lap to a stage
+        :param stage: the name of the stage
+        """
+        now = time.perf_counter()
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + now - self.last
+        self.last = now
+
+    def lap_attribute(self, stage, key):
+        """
+        add the time since the last lap to a stage and to an attribute
+        :param stage: the name of the stage
+        :param key: the attribute name
+        """
+        now = time.perf_counter()
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + now - self.last
+        self.attributes[key] = self.attributes.get(key, 0.0) + now - self.last
+        self.last = now
+
+    def count(self, name, n=1):
+        """
+        :param name: the name of the counter
+        :param n: the increment
+        """
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def finish(self):
+        self.total_seconds = time.perf_counter() - self.started
+
+    def to_json(self):
+        return {"query": self.query, "total_seconds": self.total_seconds, "seconds": self.seconds,
+                "counters": self.counters, "attributes": self.attributes}
+
+
+class CountedFunction(object):
+    """
+    a function counting its calls in the current query of a Profiler, it can be pickled to the worker processes
+    """
+
+    def __init__(self, profiler, function, name):
+        self.profiler = profiler
+        self.function = function
+        self.name = name
+
+    def __call__(self, *args):
+        if self.profiler.current is not None:
+            self.profiler.current.count(self.name)
+        return self.function(*args)
+
+
+class Profiler(object):
+    """
+    an opt-in instrumentation of the tagging: the wall time of the stages of each query, the similarity calls and the
+    candidate and match counters. only a sample of the queries is profiled, the others run without any instrumentation,
+    the profiled queries can be written to a json lines trace file
+    """
+
+    def __init__(self, sample_rate=1.0, trace_path=None, slowest=10, seed=None):
+        """
+        :param sample_rate: the fraction of the queries which are profiled
+        :param trace_path: each profiled query is written to this json lines file if it is not None
+        :param slowest: the number of the slowest queries kept for the summary
+        :param seed: the seed of the sampling
+        """
+        self.sample_rate = sample_rate
+        self.trace_path = trace_path
+        self.trace = None
+        self.slowest = slowest
+        self.random = random.Random(seed)
+        self.current = None
+        self.queries = 0
+        self.profiled = 0
+        self.total_seconds = 0.0
+        self.seconds = {}
+        self.counters = {}
+        self.attributes = {}
+        # a min-heap of (total seconds, the order of the query, the profile) of the slowest queries
+        self.slowest_queries = []
+
+    def __getstate__(self):
+        # the worker processes return their profiles, only this process writes the trace
+        state = dict(self.__dict__)
+        state["trace"] = None
+        state["trace_path"] = None
+        return state
+
+    def count_calls(self, function, name="similarity_calls"):
+        """
+        wrap a function to count its calls in the current query
+        :param function: e.g. the score function of a SimilarityCache
+        :param name: the name of the counter
+        :return: the wrapped function
+        """
+        return CountedFunction(self, function, name)
+
+    def start_query(self, query):
+        """
+        decide whether a query is profiled
+        :param query: a query string
+        :return: a QueryProfile which string_match fills, None if the query is not profiled
+        """
+        self.queries = self.queries + 1
+        if self.sample_rate < 1.0 and self.random.random() >= self.sample_rate:
+            self.current = None
+            return None
+        self.current = QueryProfile(query)
+        return self.current
+
+    def finish_query(self, profile):
+        """
+        add a profiled query to the summary and the trace
+        :param profile: the QueryProfile returned by start_query, or returned by a worker process
+        """
+        self.current = None
+        if profile is None:
+            return
+        if profile.total_seconds == 0.0:
+            profile.finish()
+        self.profiled = self.profiled + 1
+        self.total_seconds = self.total_seconds + profile.total_seconds
+        for stage, seconds in profile.seconds.items():
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+        for name, n in profile.counters.items():
+            self.counters[name] = self.counters.get(name, 0) + n
+        for key, seconds in profile.attributes.items():
+            self.attributes[key] = self.attributes.get(key, 0.0) + seconds
+        heapq.heappush(self.slowest_queries, (profile.total_seconds, self.profiled, profile))
+        if len(self.slowest_queries) > self.slowest:
+            heapq.heappop(self.slowest_queries)
+        if self.trace_path is not None:
+            if self.trace is None:
+                self.trace = open(self.trace_path, "a", buffering=1 << 20)
+            self.trace.write(json.dumps(profile.to_json()) + "\n")
+
+    def add_time(self, stage, seconds):
+        """
+        add the time of a stage outside the queries, e.g. loading the click log
+        :param stage: the name of the stage
+        :param seconds: the wall time
+        """
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def timed(self, items, stage):
+        """
+        time the iteration of a lazy iterable, e.g. the parsing of the click log
+        :param items: an iterable
+        :param stage: the name of the stage
+        :return: a generator of the items
+        """
+        iterator = iter(items)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(stage, time.perf_counter() - started)
+                return
+            self.add_time(stage, time.perf_counter() - started)
+            yield item
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
+
+    def summary(self):
+        """
+        :return: dict: the totals of the stages and the counters, the slowest queries and attributes
+        """
+        return {"queries": self.queries, "profiled_queries": self.profiled, "query_seconds": self.total_seconds,
+                "seconds": self.seconds, "counters": self.counters,
+                "slowest_attributes": sorted(self.attributes.items(), key=lambda item: -item[1])[:self.slowest],
+                "slowest_queries": [profile.to_json() for _, _, profile in sorted(self.slowest_queries, reverse=True)]}
+
+    def report(self):
+        """
+        :return: the lines describing the summary
+        """
+        lines = ["Profile: {} of {} queries profiled, {:.3f} s in the profiled queries".format(
+            self.profiled, self.queries, self.total_seconds)]
+        for stage, seconds in sorted(self.seconds.items(), key=lambda item: -item[1]):
+            lines.append("  stage {}: {:.3f} s".format(stage, seconds))
+        for name, n in sorted(self.counters.items()):
+            lines.append("  {}: {} ({:.1f} per query)".format(name, n, n / self.profiled if self.profiled > 0 else 0))
+        for key, seconds in sorted(self.attributes.items(), key=lambda item: -item[1])[:self.slowest]:
+            lines.append("  attribute {}: {:.3f} s".format(key, seconds))
+        for total_seconds, _, profile in sorted(self.slowest_queries, reverse=True):
+            lines.append("  query {!r}: {:.3f} ms".format(profile.query, total_seconds * 1000))
+        return "\n".join(lines)
+
+
+def common_prefix_length(w1, w2):
+    """
+    the length of the common prefix of two words, jaro-winkler counts at most 4 characters
+    :param w1: the first input word
+    :param w2: the second input word
+    :return: the length of the common prefix
+    """
+    prefix = 0
+    for c1, c2 in zip(w1[:4], w2[:4]):
+        if c1 != c2:
+            break
+        prefix = prefix + 1
+    return prefix
+
+
+def jaro_winkler_upper_bound(length1, length2, common, prefix):
+    """
+    an upper bound of the jaro-winkler score of two words. jaro-winkler compares the lower case words, the number of
+    matching characters is at most the number of their common characters and the transposition term is at most 1.
+    the bound doesn't hold for the words containing "*", see jaro_winkler_prunable
+    :param length1: the length of the first lower case word
+    :param length2: the length of the second lower case word
+    :param common: the number of common characters (with repetition) of the two lower case words, or a bound of it
+    :param prefix: the length of the common prefix of the two words
+    :return: a score which is not less than the jaro-winkler score of the two words
+    """
+    jaro = (common / length1 + common / length2 + 1) / 3
+    return jaro + 0.1 * prefix * (1 - jaro)
+
+
+def bound_reaches(bound, threshold):
+    """
+    check whether a bound of the jaro-winkler score reaches the threshold. pyjarowinkler rounds the score to 2 decimals,
+    the rounding is monotone, so the rounded bound is compared, the small tolerance absorbs floating point errors
+    :param bound: an upper bound of the jaro-winkler score
+    :param threshold: the threshold to determine whether two word are similar or not
+    :return: False if no score below the bound can reach the threshold
+    """
+    return round(bound + 1e-9, 2) >= threshold
+
+
+def jaro_winkler_prunable(word):
+    """
+    pyjarowinkler marks the matched characters with "*" in place, so a "*" of the other word also matches the marks
+    and the number of matches may exceed the common characters and the length of the shorter word
+    :param word: a word
+    :return: False if the bounds of jaro_winkler_upper_bound don't hold for the pairs of this word
+    """
+    return "*" not in word
+
+
+def jaro_winkler_reachable(w1, w2, threshold):
+    """
+    check the length and character bounds of two words before computing their jaro-winkler score
+    :param w1: the first input word
+    :param w2: the second input word
+    :param threshold: the threshold to determine whether two word are similar or not
+    :return: False if the jaro-winkler score of the two words is surely below the threshold
+    """
+    # empty words and the words with "*" are left to the similarity function
+    if len(w1) == 0 or len(w2) == 0 or not jaro_winkler_prunable(w1) or not jaro_winkler_prunable(w2):
+        return True
+    lower1 = w1.lower()
+    lower2 = w2.lower()
+    prefix = common_prefix_length(w1, w2)
+    # the length bound: at most all the characters of the shorter word are common
+    if not bound_reaches(jaro_winkler_upper_bound(len(lower1), len(lower2), min(len(lower1), len(lower2)), prefix),
+                         threshold):
+        return False
+    common = sum((Counter(lower1) & Counter(lower2)).values())
+    return bound_reaches(jaro_winkler_upper_bound(len(lower1), len(lower2), common, prefix), threshold)
+
+
+def character_codes(words):
+    """
+    encode the words as a padded array of code points
+    :param words: a list of words
+    :return:
+        codes: an int32 array of shape (len(words), the length of the longest word), padded with -1
+        lengths: the length of each word
+    """
+    lengths = np.array([len(word) for word in words], dtype=np.int64)
+    width = int(lengths.max()) if len(words) > 0 and lengths.max() > 0 else 1
+    codes = np.full((len(words), width), -1, dtype=np.int32)
+    for row, word in enumerate(words):
+        if len(word) > 0:
+            codes[row, :len(word)] = np.frombuffer(word.encode("utf-32-le"), dtype=np.uint32)
+    return codes, lengths
+
+
+def matching_characters(first, first_lengths, second, second_lengths, limits):
+    """
+    the vectorized matching step of jaro-winkler as pyjarowinkler does it: each character of first matches if it is in
+    the window of second, then the first unused occurrence of it in second is replaced by "*"
+    :param first: the padded code points of the first words, one word per row
+    :param first_lengths: the length of each first word
+    :param second: the padded code points of the second words, it is not modified
+    :param second_lengths: the length of each second word
+    :param limits: the half width of the matching window of each row
+    :return: the matched code points of each row in the order of first, -1 for the characters not matched
+    """
+    second = second.copy()
+    rows = np.arange(len(first))
+    columns = np.arange(second.shape[1])[None, :]
+    common = np.full(first.shape, -1, dtype=np.int32)
+    inside = columns < second_lengths[:, None]
+    for i in range(first.shape[1]):
+        character = first[:, i]
+        equal = (second == character[:, None]) & inside
+        left = np.maximum(0, i - limits)[:, None]
+        right = np.minimum(i + limits + 1, second_lengths)[:, None]
+        found = (i < first_lengths) & (equal & (columns >= left) & (columns < right)).any(axis=1)
+        second[rows[found], equal.argmax(axis=1)[found]] = ord("*")
+        common[found, i] = character[found]
+    return common
+
+
+class SimilarityKernel(object):
+    """
+    a vocabulary encoded as NumPy arrays, a word is scored against all the words of the vocabulary in one shot: trigram
+    Jaccard from the trigram incidence lists and jaro-winkler from padded character arrays. the scores are the same as
+    similarity_score, pairs with an empty word, which pyjarowinkler rejects, score 0 with jaro-winkler
+    """
+
+    def __init__(self, vocabulary, block_size=4096):
+        """
+        :param vocabulary: a list of words
+        :param block_size: the number of words scored at a time by jaro-winkler, it bounds the size of the arrays
+        """
+        self.vocabulary = vocabulary
+        self.block_size = block_size
+        # the trigram incidence: the ids of the words containing each trigram, and the trigram count of each word
+        self.gram_ids = None
+        self.gram_words = None
+        self.trigram_sizes = None
+        # the lower case code points and lengths, the original lengths and the first 4 original code points
+        self.lower_codes = None
+        self.lower_lengths = None
+        self.raw_lengths = None
+        self.raw_prefixes = None
+        # the words containing "*", they are never pruned by the bound
+        self.unprunable = None
+
+    def build_trigram_arrays(self):
+        """
+        build the trigram incidence of the vocabulary
+        """
+        gram_words = {}
+        trigram_sizes = []
+        for word_id, word in enumerate(self.vocabulary):
+            trigram_set = set(trigram(word.lower()))
+            trigram_sizes.append(len(trigram_set))
+            for gram in trigram_set:
+                gram_words.setdefault(gram, []).append(word_id)
+        self.gram_ids = {gram: gram_id for gram_id, gram in enumerate(gram_words)}
+        self.gram_words = [np.array(word_ids, dtype=np.int64) for word_ids in gram_words.values()]
+        self.trigram_sizes = np.array(trigram_sizes, dtype=np.int64)
+
+    def build_character_arrays(self):
+        """
+        build the padded character arrays of the vocabulary
+        """
+        words = list(self.vocabulary)
+        self.lower_codes, self.lower_lengths = character_codes([word.lower() for word in words])
+        raw_codes, _ = character_codes([word[:4] for word in words])
+        self.raw_lengths = np.array([len(word) for word in words], dtype=np.int64)
+        self.raw_prefixes = np.full((len(words), 4), -1, dtype=np.int32)
+        self.raw_prefixes[:, :raw_codes.shape[1]] = raw_codes
+        self.unprunable = np.array([not jaro_winkler_prunable(word) for word in words], dtype=bool)
+
+    def trigram_scores(self, word):
+        """
+        :param word: a word of the query
+        :return: the trigram Jaccard score of the word and each word of the vocabulary
+        """
+        if self.gram_ids is None:
+            self.build_trigram_arrays()
+        word_trigram = set(trigram(word.lower()))
+        postings = [self.gram_words[self.gram_ids[gram]] for gram in word_trigram if gram in self.gram_ids]
+        shared = np.zeros(len(self.trigram_sizes), dtype=np.int64)
+        if len(postings) > 0:
+            shared = np.bincount(np.concatenate(postings), minlength=len(self.trigram_sizes))
+        return shared / (len(word_trigram) + self.trigram_sizes - shared)
+
+    def jaro_winkler_scores(self, word, threshold=None):
+        """
+        :param word: a word of the query
+        :param threshold: if it is given, the words whose length and prefix bound can not reach it are not scored
+        :return: the jaro-winkler score of the word and each word of the vocabulary, 0 for the words not scored
+        """
+        if self.lower_codes is None:
+            self.build_character_arrays()
+        scores = np.zeros(len(self.lower_lengths))
+        lower_word = word.lower()
+        if len(word) == 0 or len(lower_word) == 0:
+            return scores
+        word_codes, word_lengths = character_codes([lower_word])
+        raw_word_codes, _ = character_codes([word[:4]])
+        word_prefix = np.full(4, -1, dtype=np.int32)
+        word_prefix[:raw_word_codes.shape[1]] = raw_word_codes[0]
+        # the common prefix of the original words, at most 4 characters
+        same = np.cumprod(self.raw_prefixes == word_prefix[None, :], axis=1).sum(axis=1)
+        prefixes = np.minimum(same, np.minimum(self.raw_lengths, len(word)))
+        candidates = self.lower_lengths > 0
+        if threshold is not None and jaro_winkler_prunable(word):
+            most_common = np.minimum(self.lower_lengths, len(lower_word))
+            jaro = (most_common / len(lower_word) + most_common / np.maximum(self.lower_lengths, 1) + 1) / 3
+            bounds = jaro + 0.1 * prefixes * (1 - jaro)
+            candidates = candidates & ((np.round(bounds + 1e-9, 2) >= threshold - 0.01) | self.unprunable)
+        rows = np.flatnonzero(candidates)
+        for start in range(0, len(rows), self.block_size):
+            block = rows[start:start + self.block_size]
+            scores[block] = self.jaro_winkler_block(word, word_codes[0], len(lower_word), block, prefixes[block])
+        return scores
+
+    def jaro_winkler_block(self, word, word_codes, word_length, block, prefixes):
+        """
+        the jaro-winkler scores of a word and a block of the vocabulary, computed as pyjarowinkler does
+        :param word: the original word of the query
+        :param word_codes: the code points of the lower case word
+        :param word_length: the length of the lower case word
+        :param block: the ids of the vocabulary words
+        :param prefixes: the common prefix length of the word and each vocabulary word
+        :return: the scores rounded to 2 decimals
+        """
+        lengths = self.lower_lengths[block]
+        width = max(int(lengths.max()), word_length)
+        codes = np.full((len(block), width), -1, dtype=np.int32)
+        codes[:, :self.lower_codes.shape[1]] = self.lower_codes[block, :width]
+        query_codes = np.full((len(block), width), -1, dtype=np.int32)
+        query_codes[:, :word_length] = word_codes[:word_length]
+        query_lengths = np.full(len(block), word_length, dtype=np.int64)
+        # pyjarowinkler takes the query word as the shorter one unless it is strictly longer
+        query_longer = len(word) > self.raw_lengths[block]
+        shorter = np.where(query_longer[:, None], codes, query_codes)
+        longer = np.where(query_longer[:, None], query_codes, codes)
+        shorter_lengths = np.where(query_longer, lengths, query_lengths)
+        longer_lengths = np.where(query_longer, query_lengths, lengths)
+        limits = np.minimum(shorter_lengths, longer_lengths) // 2
+        common1 = matching_characters(shorter, shorter_lengths, longer, longer_lengths, limits)
+        common2 = matching_characters(longer, longer_lengths, shorter, shorter_lengths, limits)
+        matches1 = (common1 >= 0).sum(axis=1)
+        matches2 = (common2 >= 0).sum(axis=1)
+        # the matched characters in order, then the transpositions between the two sequences
+        common1 = np.take_along_axis(common1, np.argsort(common1 < 0, axis=1, kind="stable"), axis=1)
+        common2 = np.take_along_axis(common2, np.argsort(common2 < 0, axis=1, kind="stable"), axis=1)
+        paired = np.arange(width)[None, :] < np.minimum(matches1, matches2)[:, None]
+        transpositions = ((common1 != common2) & paired).sum(axis=1) // 2
+        matched = (matches1 > 0) & (matches2 > 0)
+        safe_matches1 = np.maximum(matches1, 1)
+        jaro = (matches1 / shorter_lengths + matches2 / longer_lengths
+                + (matches1 - transpositions) / safe_matches1) / 3.0
+        jaro = np.where(matched, jaro, 0.0)
+        scores = jaro + (0.1 * prefixes * (1.0 - jaro))
+        # pyjarowinkler rounds with round(score * 100.0) / 100.0, np.round rounds the halves to even as round does
+        return np.round(scores * 100.0) / 100.0
+
+    def scores(self, word, algorithm, threshold=None):
+        """
+        :param word: a word of the query
+        :param algorithm: the name of the algorithm to calculate the similarity
+        :param threshold: the words which can not reach the threshold may score 0 instead of their exact scores
+        :return: the similarity score of the word and each word of the vocabulary
+        """
+        if algorithm == "trigram":
+            return self.trigram_scores(word)
+        return self.jaro_winkler_scores(word, threshold)
+
+
+def similarity_matrix(query_words, vocabulary, algorithm):
+    """
+    Computes the similarity scores of each query word and each vocabulary word in one shot
+    :param query_words: a list of words
+    :param vocabulary: a list of words
+    :param algorithm: the name of the algorithm to calculate the similarity
+    :return: an array of shape (len(query_words), len(vocabulary)), the same scores as similarity_score
+    """
+    kernel = SimilarityKernel(vocabulary)
+    matrix = np.zeros((len(query_words), len(vocabulary)))
+    for row, word in enumerate(query_words):
+        matrix[row] = kernel.scores(word, algorithm)
+    return matrix
+
+
+def pair_attributes(attribute_set):
+    """
+    pair the B-xx and I-xx labels of the attribute set in one pass
+    :param attribute_set: a set of the attribute value
+    :return: a list of the paired labels: [B-xx, I-xx, B-yy, I-yy, ...], the pairs are in the order of the set
+    """
+    attribute_list = list(attribute_set)
+    # the position of the next label of the same attribute
+    next_position = [None] * len(attribute_list)
+    last_position = {}
+    for i in range(len(attribute_list) - 1, -1, -1):
+        next_position[i] = last_position.get(attribute_list[i][2:])
+        last_position[attribute_list[i][2:]] = i
+    # store the sorted attribute value
+    order_no_repeat = []
+    for i in range(len(attribute_list)):
+        j = next_position[i]
+        if j is not None:
+            # we put the B-xx in front of I-xx by default
+            if attribute_list[i][0] == "B":
+                order_no_repeat.append(attribute_list[i])
+                order_no_repeat.append(attribute_list[j])
+            else:
+                order_no_repeat.append(attribute_list[j])
+                order_no_repeat.append(attribute_list[i])
+    return order_no_repeat
 
 
 def get_memo_matrix(query, attribute_set):
@@ -54,22 +787,7 @@ def get_memo_matrix(query, attribute_set):
     :param attribute_set: a set of the attribute value
     :return: a matrix
     """
-    attribute_list = list(attribute_set)
-    # store the sorted attribute value
-    order_no_repeat = []
-    for i in range(len(attribute_list) - 1):
-        for j in range(i + 1, len(attribute_list)):
-            if attribute_list[i][2:] == attribute_list[j][2:]:
-                # find B-xx and I-xx
-                # we put the B-xx in front of I-xx by default
-                if attribute_list[i][0] == "B":
-                    order_no_repeat.append(attribute_list[i])
-                    order_no_repeat.append(attribute_list[j])
-                else:
-                    order_no_repeat.append(attribute_list[j])
-                    order_no_repeat.append(attribute_list[i])
-                # once find one, break
-                break
+    order_no_repeat = pair_attributes(attribute_set)
     if len(order_no_repeat) == 0:
         longest_match_flag = 0
     else:
@@ -119,75 +837,786 @@ def find_longest_value(query, attribute_set):
     return memo, lookup_chain, attribute_list
 
 
+def candidate_spans(query, attribute_list):
+    """
+    find the candidate spans of the paired labels: a run of a I-xx label begins one word before the run with the B-xx
+    label, a single B-xx label is a span of length 1
+    :param query: a labeled query with the format: [{'tesla': {'B-BR'}}, {'red': {'B-CO'}}, ...]
+    :param attribute_list: the paired labels returned by pair_attributes
+    :return: a list of (length, row, start, end), row is the position of the last label of the span in attribute_list
+    """
+    spans = []
+    for row in range(len(attribute_list)):
+        label = attribute_list[row]
+        start = None
+        for i in range(len(query) + 1):
+            # each element of the query only has one key, so we use [0]
+            has_label = i < len(query) and label in query[i][list(query[i].keys())[0]]
+            if label[0] == "B":
+                if has_label:
+                    spans.append((1, row, i, i))
+            elif has_label and start is None:
+                start = i
+            elif not has_label and start is not None:
+                # the I-xx run start..i-1, the previous word takes the B-xx label
+                begin = start - 1 if start > 0 else start
+                spans.append((i - begin, row, begin, i - 1))
+                start = None
+    return spans
+
+
 def longest_value_match(query, attribute_set):
     """
     for multi labels, use this function to only match the longest attribute value. If the query only have one label for
     each token, we don't need to use this function to deal with the query.
+    the candidate spans are scheduled greedily: the longest first, and among the spans of the same length the one whose
+    label comes first in the paired labels, then the one ending first. each word of a span which still has more than
+    one labels keeps the label of the span. the spans of a single B-xx label are only used if there is no longer span
     :param query: a query some elements of which have more than one labels
     :param attribute_set: the attribute the length of the value of which is more than 2
     :return: the query each token of which only has one label
     """
-    memo, lookup_chain, attribute_list = find_longest_value(query, attribute_set)
-    # the memo and lookup_chain have one more row and column, delete them before iterate the matrix
-    memo = np.delete(memo, 0, axis=0)
-    memo = np.delete(memo, 0, axis=1)
-    lookup_chain = np.delete(lookup_chain, 0, axis=0)
-    lookup_chain = np.delete(lookup_chain, 0, axis=1)
-    while True:
-        max_value = max(max(row) for row in memo)
-        row_index = 0
-        for row in memo:
-            column_index = 0
-            for column in row:
-                # column is the one contains the last element of the longest attribute value, we use the lookup_chain
-                # to update query, if the column contains more than one max value, we deal with the first one
-                if column == max_value:
-                    # we find the longest value backward
-                    while True:
-                        # we need to clear the memo corresponding to the longest value
-                        memo[row_index, column_index] = 0
-                        # we need to delete all other attributes, and only keep the name of this row, which is kept
-                        # in the attribute_list
-                        # first we need to get the key, each element of the query only has one key, so we use [0]
-                        key_list = list(query[column_index].keys())
-                        key = key_list[0]
-                        # if the token have more than one attribute values, we need to delete and keep
-                        if len(query[column_index][key]) > 1:
-                            query[column_index][key].clear()
-                            # print(row_index, column_index)
-                            # after we delete the attribute value, we need to add the name of this row
-                            query[column_index][key].add(attribute_list[row_index])
-                        if lookup_chain[row_index, column_index] == 2:
-                            # we need to update the next location according to the flag
-                            row_index = row_index - 1
-                            column_index = column_index - 1
-                        elif lookup_chain[row_index, column_index] == 1:
-                            # we need to update the next location according to the flag
-                            column_index = column_index - 1
-                        # the last element of the attribute value
-                        else:
-                            break
-                column_index = column_index + 1
-            row_index = row_index + 1
-        # if each value of the memo is less than 2, we don't need to mach the longest value
-        if max(max(row) for row in memo) < 2:
-            break
+    attribute_list = pair_attributes(attribute_set)
+    spans = candidate_spans(query, attribute_list)
+    if any(span[0] > 1 for span in spans):
+        spans = [span for span in spans if span[0] > 1]
+    spans.sort(key=lambda span: (-span[0], span[1], span[3]))
+    for length, row, start, end in spans:
+        for i in range(end, start - 1, -1):
+            key = list(query[i].keys())[0]
+            # if the token have more than one attribute values, we need to delete and keep
+            if len(query[i][key]) > 1:
+                query[i][key].clear()
+                # the first word of a I-xx run takes the B-xx label of the previous row
+                if i == start and attribute_list[row][0] != "B" and start < end:
+                    query[i][key].add(attribute_list[row - 1])
+                else:
+                    query[i][key].add(attribute_list[row])
     return query
 
 
-def string_match(query, logs, algorithm, threshold):
+# the first bytes of a compiled click log
+COMPILED_MAGIC = b"SMATCH\x00\x01"
+
+
+class StringTable(object):
+    """
+    a read-only list of strings stored as one utf-8 buffer and the offsets of the strings, the strings are decoded
+    when they are accessed, so a memory-mapped table costs nothing to load
+    """
+
+    def __init__(self, offsets, data):
+        """
+        :param offsets: an integer array, the i-th string is data[offsets[i]:offsets[i + 1]]
+        :param data: a uint8 array of the utf-8 encoded strings
+        """
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.data[self.offsets[index]:self.offsets[index + 1]].tobytes().decode("utf-8")
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    @staticmethod
+    def encode(strings):
+        """
+        :param strings: a list of strings
+        :return: offsets, data: the arrays of a StringTable of the strings
+        """
+        encoded = [string.encode("utf-8") for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(string) for string in encoded])
+        return offsets, np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+
+class RaggedArray(object):
+    """
+    a read-only list of integer tuples stored as flat columns and the offsets of the rows, a row of one column is a
+    tuple of integers, a row of more columns is a list of tuples
+    """
+
+    def __init__(self, offsets, *columns):
+        """
+        :param offsets: an integer array, the i-th row is column[offsets[i]:offsets[i + 1]] of each column
+        :param columns: the integer arrays of the columns
+        """
+        self.offsets = offsets
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        start = self.offsets[index]
+        end = self.offsets[index + 1]
+        if len(self.columns) == 1:
+            return tuple(self.columns[0][start:end].tolist())
+        return list(zip(*[column[start:end].tolist() for column in self.columns]))
+
+    @staticmethod
+    def encode(rows):
+        """
+        :param rows: a list of rows, each row is a sequence of integers or a sequence of tuples of integers
+        :return: offsets, columns: the arrays of a RaggedArray of the rows
+        """
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(row) for row in rows])
+        flat = [item for row in rows for item in row]
+        if len(flat) > 0 and isinstance(flat[0], tuple):
+            columns = [np.array(column, dtype=np.int32) for column in zip(*flat)]
+        else:
+            columns = [np.array(flat, dtype=np.int32)]
+        return offsets, columns
+
+
+class SortedPostings(object):
+    """
+    a read-only mapping from sorted strings to the rows of a RaggedArray, a key is found by binary search
+    """
+
+    def __init__(self, keys, rows):
+        """
+        :param keys: a sorted StringTable
+        :param rows: a RaggedArray, rows[i] belongs to keys[i]
+        """
+        self.keys = keys
+        self.rows = rows
+
+    def get(self, key, default=None):
+        index = bisect.bisect_left(self.keys, key)
+        if index < len(self.keys) and self.keys[index] == key:
+            return list(self.rows[index])
+        return default
+
+
+class Matcher(object):
+    """
+    a compiled view of the click log, it is built once and shared by all the queries.
+    each attribute value is split into words only once and the words are interned into a vocabulary, an inverted index
+    maps each word to the values containing it, so string_match only visits the values which can be fully matched
+    """
+
+    def __init__(self, logs, cache=None, normalize=False):
+        """
+        :param logs: dict: {"attribute1": ["value1", "value2", ...], "attribute2": [...], ...}
+        :param cache: a SimilarityCache shared by the queries, the scores are not cached if it is None
+        :param normalize: split the values and the queries with normalize_tokens instead of on the spaces
+        """
+        self.cache = cache
+        self.normalize = normalize
+        # the path and the memory map of a compiled click log, see load_compiled
+        self.compiled_path = None
+        self.mapped = None
+        # the attribute names, the attribute id of each value and the word ids of each value
+        self.attributes = []
+        self.value_attributes = []
+        self.value_tokens = []
+        # the original string of each value, None once it is removed. the normalized words of a value can't be joined
+        # back into it, so the values are only kept when the matcher normalizes, see to_logs
+        self.values = [] if normalize else None
+        # the distinct words of all the values, word_ids maps each word to its index in the vocabulary
+        self.vocabulary = []
+        self.word_ids = {}
+        # inverted index: postings[word_id] is a list of (value_id, position of the word in the value)
+        self.postings = []
+        # trigram index over the vocabulary, it is only built when the trigram algorithm is used
+        self.trigram_postings = None
+        self.trigram_sizes = None
+        # length and prefix buckets over the vocabulary, they are only built when jaro-winkler is used
+        self.jaro_winkler_buckets = None
+        self.character_counts = None
+        # the vocabulary words containing "*", they are always compared, see jaro_winkler_prunable
+        self.jaro_winkler_unprunable = None
+        # score the query words against the whole vocabulary with the NumPy kernel instead of word by word
+        self.vectorized = False
+        self.kernel = None
+        # the digest of the values, see version
+        self.log_version = None
+        # token-level Aho-Corasick automaton over the values, it is only built for exact matching
+        self.automaton_goto = None
+        self.automaton_fail = None
+        self.automaton_output = None
+        for key in logs:
+            attribute_id = len(self.attributes)
+            self.attributes.append(key)
+            for value in logs[key]:
+                self.add_value(attribute_id, value)
+
+    def add_value(self, attribute_id, value):
+        """
+        split a value into words and add it to the inverted index
+        :param attribute_id: the index of the attribute of the value in attributes
+        :param value: an attribute value
+        :return: the id of the value
+        """
+        value_id = len(self.value_tokens)
+        value_tokens = []
+        for position, word in enumerate(self.tokenize(value)):
+            word_id = self.intern(word)
+            self.postings[word_id].append((value_id, position))
+            value_tokens.append(word_id)
+        self.value_attributes.append(attribute_id)
+        self.value_tokens.append(tuple(value_tokens))
+        if self.values is not None:
+            self.values.append(value)
+        return value_id
+
+    def remove_value(self, value_id):
+        """
+        remove a value from the inverted index, its id is kept with no word so it is never a candidate value
+        :param value_id: the id of the value
+        """
+        for position, word_id in enumerate(self.value_tokens[value_id]):
+            self.postings[word_id].remove((value_id, position))
+        self.value_tokens[value_id] = ()
+        if self.values is not None:
+            self.values[value_id] = None
+
+    def find_values(self, key, value):
+        """
+        :param key: an attribute name
+        :param value: an attribute value
+        :return: the ids of the occurrences of the value in the attribute
+        """
+        value_tokens = tuple(self.word_id(word) for word in self.tokenize(value))
+        if key not in self.attributes or None in value_tokens or len(value_tokens) == 0:
+            return []
+        attribute_id = self.attributes.index(key)
+        # the values are found through the postings of their first word
+        return [value_id for value_id, position in self.postings[value_tokens[0]]
+                if position == 0 and self.value_attributes[value_id] == attribute_id
+                and tuple(self.value_tokens[value_id]) == value_tokens]
+
+    def apply_delta(self, delta):
+        """
+        add and remove values in place. the trigram index and the jaro-winkler buckets are updated with the new words,
+        the Aho-Corasick automaton and the NumPy kernel are rebuilt on their next use
+        :param delta: dict: {"add": {"attribute1": ["value1", ...], ...}, "remove": {"attribute1": [...], ...}}, a
+                      malformed delta raises ValueError before anything is changed
+        :return: dict: {"attribute1": ["value1", ...], ...}, the values which are added or removed, see affected_queries
+        """
+        if self.compiled_path is not None:
+            raise ValueError("a compiled click log is read-only, compile the updated json click log instead")
+        # the whole delta is checked first, a malformed delta leaves the matcher unchanged
+        if not isinstance(delta, dict) or not set(delta) <= {"add", "remove"}:
+            raise ValueError('the delta must be a json object of "add" and "remove"')
+        for action, logs in delta.items():
+            if not isinstance(logs, dict) or not all(isinstance(key, str) and isinstance(values, list)
+                                                     and all(isinstance(value, str) for value in values)
+                                                     for key, values in logs.items()):
+                raise ValueError('"{}" must map each attribute to a list of values'.format(action))
+        changed_logs = {}
+        for key, values in delta.get("remove", {}).items():
+            for value in values:
+                value_ids = self.find_values(key, value)
+                for value_id in value_ids:
+                    self.remove_value(value_id)
+                if len(value_ids) > 0:
+                    changed_logs.setdefault(key, []).append(value)
+        for key, values in delta.get("add", {}).items():
+            if key not in self.attributes:
+                self.attributes.append(key)
+            attribute_id = self.attributes.index(key)
+            for value in values:
+                vocabulary_size = len(self.vocabulary)
+                self.add_value(attribute_id, value)
+                for word_id in range(vocabulary_size, len(self.vocabulary)):
+                    self.index_word(word_id)
+                changed_logs.setdefault(key, []).append(value)
+        if len(changed_logs) > 0:
+            self.log_version = None
+            self.kernel = None
+            self.automaton_goto = None
+        return changed_logs
+
+    def to_logs(self):
+        """
+        :return: dict: {"attribute1": ["value1", "value2", ...], ...}, the click log of the matcher, a normalized
+                 matcher writes the original values and not their normalized words
+        """
+        logs = {key: [] for key in self.attributes}
+        for value_id in range(len(self.value_tokens)):
+            if self.values is not None:
+                value = self.values[value_id]
+            elif len(self.value_tokens[value_id]) > 0:
+                value = " ".join(self.vocabulary[word_id] for word_id in self.value_tokens[value_id])
+            else:
+                value = None
+            if value is not None:
+                logs[self.attributes[self.value_attributes[value_id]]].append(value)
+        return logs
+
+    def tokenize(self, text):
+        """
+        split an attribute value or a query into words
+        :param text: a value or a query without its line break
+        :return: a list of words, the normalized tokens if the matcher normalizes
+        """
+        if self.normalize:
+            return normalize_tokens(text)
+        return text.split(" ")
+
+    def intern(self, word):
+        """
+        get the id of the word, a new id is assigned if the word is not in the vocabulary
+        :param word: a word of an attribute value
+        :return: the id of the word
+        """
+        word_id = self.word_ids.get(word)
+        if word_id is None:
+            word_id = len(self.vocabulary)
+            self.word_ids[word] = word_id
+            self.vocabulary.append(word)
+            self.postings.append([])
+        return word_id
+
+    def save(self, path):
+        """
+        write the matcher into a compact binary file: the interned vocabulary, the word ids and the attribute id of each
+        value, the inverted index and the trigram index are stored as flat arrays which load_compiled memory-maps
+        :param path: the path of the compiled click log
+        """
+        if self.trigram_postings is None:
+            self.build_trigram_index()
+        grams = sorted(self.trigram_postings)
+        arrays = []
+        vocabulary_offsets, vocabulary_data = StringTable.encode(list(self.vocabulary))
+        arrays.extend([("vocabulary_offsets", vocabulary_offsets), ("vocabulary_data", vocabulary_data)])
+        arrays.append(("value_attributes", np.array(self.value_attributes, dtype=np.int32)))
+        value_offsets, value_columns = RaggedArray.encode([self.value_tokens[index]
+                                                           for index in range(len(self.value_tokens))])
+        arrays.extend([("value_offsets", value_offsets), ("value_tokens", value_columns[0])])
+        posting_offsets, posting_columns = RaggedArray.encode([self.postings[index]
+                                                               for index in range(len(self.postings))])
+        if len(posting_columns) == 1:
+            # no posting at all, keep the two columns
+            posting_columns = [posting_columns[0], posting_columns[0]]
+        arrays.extend([("posting_offsets", posting_offsets), ("posting_values", posting_columns[0]),
+                       ("posting_positions", posting_columns[1])])
+        gram_offsets, gram_data = StringTable.encode(grams)
+        arrays.extend([("gram_offsets", gram_offsets), ("gram_data", gram_data)])
+        gram_posting_offsets, gram_posting_columns = RaggedArray.encode([self.trigram_postings[gram] for gram in grams])
+        arrays.extend([("gram_posting_offsets", gram_posting_offsets), ("gram_postings", gram_posting_columns[0]),
+                       ("trigram_sizes", np.array(self.trigram_sizes, dtype=np.int32))])
+        # the arrays are aligned to 8 bytes, their offsets are relative to the end of the header
+        sections = {}
+        offset = 0
+        for name, array in arrays:
+            sections[name] = [offset, array.dtype.str, len(array)]
+            offset = offset + (array.nbytes + 7) // 8 * 8
+        header = json.dumps({"attributes": self.attributes, "normalize": self.normalize,
+                             "sections": sections}).encode("utf-8")
+        header = header + b" " * (-len(header) % 8)
+        with open(path, "wb") as compiled_log:
+            compiled_log.write(COMPILED_MAGIC)
+            compiled_log.write(len(header).to_bytes(8, "little"))
+            compiled_log.write(header)
+            for name, array in arrays:
+                compiled_log.write(array.tobytes())
+                compiled_log.write(b"\x00" * (-array.nbytes % 8))
+
+    @classmethod
+    def load_compiled(cls, path, cache=None):
+        """
+        memory-map a click log compiled by save, nothing is parsed or copied, the pages are shared by all the processes
+        reading the same file
+        :param path: the path of the compiled click log
+        :param cache: a SimilarityCache shared by the queries, the scores are not cached if it is None
+        :return: a read-only Matcher
+        """
+        with open(path, "rb") as compiled_log:
+            mapped = mmap.mmap(compiled_log.fileno(), 0, access=mmap.ACCESS_READ)
+        header_length = int.from_bytes(mapped[len(COMPILED_MAGIC):len(COMPILED_MAGIC) + 8], "little")
+        start = len(COMPILED_MAGIC) + 8
+        header = json.loads(mapped[start:start + header_length].decode("utf-8"))
+        start = start + header_length
+        arrays = {}
+        for name, (offset, dtype, count) in header["sections"].items():
+            arrays[name] = np.frombuffer(mapped, dtype=np.dtype(dtype), count=count, offset=start + offset)
+        matcher = cls({}, cache)
+        matcher.compiled_path = path
+        matcher.mapped = mapped
+        matcher.attributes = header["attributes"]
+        matcher.normalize = header.get("normalize", False)
+        matcher.value_attributes = arrays["value_attributes"]
+        matcher.value_tokens = RaggedArray(arrays["value_offsets"], arrays["value_tokens"])
+        matcher.vocabulary = StringTable(arrays["vocabulary_offsets"], arrays["vocabulary_data"])
+        # a compiled matcher is read-only, no word is interned
+        matcher.word_ids = None
+        matcher.postings = RaggedArray(arrays["posting_offsets"], arrays["posting_values"], arrays["posting_positions"])
+        matcher.trigram_postings = SortedPostings(StringTable(arrays["gram_offsets"], arrays["gram_data"]),
+                                                  RaggedArray(arrays["gram_posting_offsets"], arrays["gram_postings"]))
+        matcher.trigram_sizes = arrays["trigram_sizes"]
+        return matcher
+
+    def __getstate__(self):
+        # a memory-mapped matcher is pickled by its path, the other process maps the same file
+        if self.compiled_path is not None:
+            return {"compiled_path": self.compiled_path, "cache": self.cache}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if state["compiled_path"] is not None and "vocabulary" not in state:
+            state = Matcher.load_compiled(state["compiled_path"], state["cache"]).__dict__
+        self.__dict__.update(state)
+
+    def version(self):
+        """
+        a digest of the click log, the raw bytes of a compiled log or the attribute and the words of each value
+        :return: a hex string which changes when the click log changes
+        """
+        if self.log_version is None:
+            digest = hashlib.sha1()
+            if self.mapped is not None:
+                digest.update(self.mapped)
+            else:
+                # the same words are not found in the same queries when the queries are normalized
+                if self.normalize:
+                    digest.update(b"normalize")
+                digest.update(json.dumps(self.attributes).encode("utf-8"))
+                for value_id in range(len(self.value_tokens)):
+                    digest.update(json.dumps([int(self.value_attributes[value_id])]
+                                             + [self.vocabulary[word_id] for word_id in self.value_tokens[value_id]]
+                                             ).encode("utf-8"))
+            self.log_version = digest.hexdigest()
+        return self.log_version
+
+    def similarity(self, w1, w2, algorithm, threshold):
+        """
+        the similarity function going through the cache of the matcher
+        :param w1: the first input word
+        :param w2: the second input word
+        :param algorithm: the name of the algorithm to calculate the similarity
+        :param threshold: the threshold to determine whether two word are similar or not
+        :return: whether the two words are similar
+        """
+        if self.cache is None:
+            return similarity(w1, w2, algorithm, threshold)
+        return self.cache.score(w1, w2, algorithm) >= threshold
+
+    def similar_words(self, word, algorithm, threshold):
+        """
+        find the words in the vocabulary which are similar with the input word
+        :param word: a word of the query
+        :param algorithm: the name of the algorithm to calculate the similarity
+        :param threshold: the threshold to determine whether two word are similar or not
+        :return: a set of the ids of the similar words
+        """
+        if self.vectorized:
+            if self.kernel is None:
+                self.kernel = SimilarityKernel(self.vocabulary)
+            return set(np.flatnonzero(self.kernel.scores(word, algorithm, threshold) >= threshold).tolist())
+        if algorithm == "trigram":
+            return self.similar_trigram_words(word, threshold)
+        if algorithm == "jaro-winkler" and threshold > 0 and len(word) > 0:
+            return self.similar_jaro_winkler_words(word, threshold)
+        return {word_id for word_id, value_word in enumerate(self.vocabulary)
+                if self.similarity(word, value_word, algorithm, threshold)}
+
+    def resolve_words(self, queries, algorithm, threshold, exact=False):
+        """
+        look up the similar words of the distinct words of a batch of queries once for the whole batch
+        :param queries: a list of query strings
+        :param algorithm: the name of the algorithm to calculate the similarity
+        :param threshold: the threshold to determine whether two word are similar or not
+        :param exact: skip the words found in the vocabulary, string_match matches them exactly
+        :return: dict: {word: a set of the ids of the similar words}, the resolved_words of string_match
+        """
+        resolved_words = {}
+        for query in queries:
+            for word in self.tokenize(query.strip("\n")):
+                if word in resolved_words or (exact and self.word_id(word) is not None):
+                    continue
+                resolved_words[word] = self.similar_words(word, algorithm, threshold)
+        return resolved_words
+
+    def warm(self, algorithm, exact=False):
+        """
+        build the lazy indexes used by string_match up front, so the first queries don't pay for them
+        :param algorithm: the name of the algorithm to calculate the similarity
+        :param exact: also build the word ids and the Aho-Corasick automaton of the exact mode
+        """
+        if self.vectorized:
+            if self.kernel is None:
+                self.kernel = SimilarityKernel(self.vocabulary)
+            if algorithm == "trigram" and self.kernel.gram_ids is None:
+                self.kernel.build_trigram_arrays()
+            elif algorithm == "jaro-winkler" and self.kernel.lower_codes is None:
+                self.kernel.build_character_arrays()
+        elif algorithm == "trigram" and self.trigram_postings is None:
+            self.build_trigram_index()
+        elif algorithm == "jaro-winkler" and self.jaro_winkler_buckets is None:
+            self.build_jaro_winkler_index()
+        if exact:
+            self.word_id("")
+            if self.automaton_goto is None:
+                self.build_automaton()
+
+    def build_trigram_index(self):
+        """
+        build the posting lists from each trigram to the ids of the vocabulary words containing it
+        """
+        self.trigram_postings = {}
+        self.trigram_sizes = []
+        for word_id in range(len(self.vocabulary)):
+            self.index_trigram_word(word_id)
+
+    def index_trigram_word(self, word_id):
+        """
+        add the next word of the vocabulary to the trigram index
+        :param word_id: the id of the word, it is len(trigram_sizes)
+        """
+        # the same lower case trigrams as the similarity function
+        trigram_set = set(trigram(self.vocabulary[word_id].lower()))
+        self.trigram_sizes.append(len(trigram_set))
+        for gram in trigram_set:
+            self.trigram_postings.setdefault(gram, []).append(word_id)
+
+    def similar_trigram_words(self, word, threshold):
+        """
+        find the similar words with the trigram index, only the words sharing enough trigrams with the input word are
+        compared: Jaccard(A, B) >= t  <=>  |A & B| >= t / (1 + t) * (|A| + |B|)
+        :param word: a word of the query
+        :param threshold: the threshold to determine whether two word are similar or not
+        :return: a set of the ids of the similar words
+        """
+        # every pair of words has a score >= 0, including the ones sharing no trigram
+        if threshold <= 0:
+            return set(range(len(self.vocabulary)))
+        if self.trigram_postings is None:
+            self.build_trigram_index()
+        word_trigram = set(trigram(word.lower()))
+        # count the shared trigrams of each vocabulary word
+        shared = {}
+        for gram in word_trigram:
+            for word_id in self.trigram_postings.get(gram, ()):
+                shared[word_id] = shared.get(word_id, 0) + 1
+        ratio = threshold / (1 + threshold)
+        # the small tolerance keeps the borderline pairs, the similarity function makes the final decision
+        return {word_id for word_id, count in shared.items()
+                if count >= ratio * (len(word_trigram) + self.trigram_sizes[word_id]) - 1e-9
+                and self.similarity(word, self.vocabulary[word_id], "trigram", threshold)}
+
+    def build_jaro_winkler_index(self):
+        """
+        bucket the vocabulary words by the length of their lower case form and then by their first 4 characters
+        """
+        self.jaro_winkler_buckets = {}
+        self.character_counts = []
+        self.jaro_winkler_unprunable = []
+        for word_id in range(len(self.vocabulary)):
+            self.index_jaro_winkler_word(word_id)
+
+    def index_jaro_winkler_word(self, word_id):
+        """
+        add the next word of the vocabulary to the jaro-winkler buckets
+        :param word_id: the id of the word, it is len(character_counts)
+        """
+        value_word = self.vocabulary[word_id]
+        lower_word = value_word.lower()
+        self.character_counts.append(Counter(lower_word))
+        if not jaro_winkler_prunable(value_word):
+            self.jaro_winkler_unprunable.append(word_id)
+            return
+        prefix_buckets = self.jaro_winkler_buckets.setdefault(len(lower_word), {})
+        prefix_buckets.setdefault(value_word[:4], []).append(word_id)
+
+    def index_word(self, word_id):
+        """
+        add a new word of the vocabulary to the indexes which are built
+        :param word_id: the id of the word
+        """
+        if self.trigram_postings is not None:
+            self.index_trigram_word(word_id)
+        if self.jaro_winkler_buckets is not None:
+            self.index_jaro_winkler_word(word_id)
+
+    def similar_jaro_winkler_words(self, word, threshold):
+        """
+        find the similar words with the jaro-winkler buckets, a whole length bucket or prefix bucket is skipped when its
+        upper bound can not reach the threshold, the remaining words are checked with the character bound before the
+        similarity function is called
+        :param word: a non-empty word of the query
+        :param threshold: the threshold to determine whether two word are similar or not
+        :return: a set of the ids of the similar words
+        """
+        if self.jaro_winkler_buckets is None:
+            self.build_jaro_winkler_index()
+        # the bounds don't hold for a word with "*", it is compared with the whole vocabulary
+        if not jaro_winkler_prunable(word):
+            return {word_id for word_id, value_word in enumerate(self.vocabulary)
+                    if self.similarity(word, value_word, "jaro-winkler", threshold)}
+        similar_word_ids = {word_id for word_id in self.jaro_winkler_unprunable
+                            if self.similarity(word, self.vocabulary[word_id], "jaro-winkler", threshold)}
+        lower_word = word.lower()
+        word_counts = Counter(lower_word)
+        for length, prefix_buckets in self.jaro_winkler_buckets.items():
+            # empty vocabulary words are left to the similarity function
+            if length > 0:
+                most_common = min(len(lower_word), length)
+                # the bound of this length with the longest possible prefix
+                if not bound_reaches(jaro_winkler_upper_bound(len(lower_word), length, most_common, 4), threshold):
+                    continue
+            for prefix, word_ids in prefix_buckets.items():
+                prefix_length = common_prefix_length(word, prefix)
+                if length > 0 and not bound_reaches(
+                        jaro_winkler_upper_bound(len(lower_word), length, most_common, prefix_length), threshold):
+                    continue
+                for word_id in word_ids:
+                    if length > 0:
+                        common = sum((word_counts & self.character_counts[word_id]).values())
+                        if not bound_reaches(jaro_winkler_upper_bound(len(lower_word), length, common, prefix_length),
+                                             threshold):
+                            continue
+                    if self.similarity(word, self.vocabulary[word_id], "jaro-winkler", threshold):
+                        similar_word_ids.add(word_id)
+        return similar_word_ids
+
+    def word_id(self, word):
+        """
+        look up a word in the vocabulary
+        :param word: a word of the query
+        :return: the id of the word, None if the word is not in the vocabulary
+        """
+        if self.word_ids is None:
+            # a compiled matcher maps its vocabulary on the first look up
+            self.word_ids = {value_word: word_id for word_id, value_word in enumerate(self.vocabulary)}
+        word_id = self.word_ids.get(word)
+        # a word only left by removed values is no longer in the click log
+        if word_id is not None and len(self.postings[word_id]) == 0:
+            return None
+        return word_id
+
+    def build_automaton(self):
+        """
+        build a token-level Aho-Corasick automaton over the word ids of all the values: automaton_goto[state] maps a
+        word id to the next state, automaton_fail[state] is the state of the longest proper suffix, and
+        automaton_output[state] lists the values ending at the state
+        """
+        self.automaton_goto = [{}]
+        self.automaton_fail = [0]
+        self.automaton_output = [[]]
+        # the trie of the values
+        for value_id in range(len(self.value_tokens)):
+            # the removed values have no word
+            if len(self.value_tokens[value_id]) == 0:
+                continue
+            state = 0
+            for word_id in self.value_tokens[value_id]:
+                next_state = self.automaton_goto[state].get(word_id)
+                if next_state is None:
+                    next_state = len(self.automaton_goto)
+                    self.automaton_goto[state][word_id] = next_state
+                    self.automaton_goto.append({})
+                    self.automaton_fail.append(0)
+                    self.automaton_output.append([])
+                state = next_state
+            self.automaton_output[state].append(value_id)
+        # the failure links in breadth first order, the states of depth 1 fail to the root
+        queue = deque(self.automaton_goto[0].values())
+        while len(queue) > 0:
+            state = queue.popleft()
+            for word_id, next_state in self.automaton_goto[state].items():
+                queue.append(next_state)
+                fail_state = self.automaton_fail[state]
+                while fail_state != 0 and word_id not in self.automaton_goto[fail_state]:
+                    fail_state = self.automaton_fail[fail_state]
+                self.automaton_fail[next_state] = self.automaton_goto[fail_state].get(word_id, 0)
+                # the values ending at the suffix also end here
+                self.automaton_output[next_state] = (self.automaton_output[next_state]
+                                                     + self.automaton_output[self.automaton_fail[next_state]])
+
+    def exact_matches(self, query_word_ids):
+        """
+        find every occurrence of every value in the query in one left-to-right pass
+        :param query_word_ids: the word id of each word of the query, None for the words not in the vocabulary
+        :return: dict: {value_id: [the position of the last word of each occurrence, ...]}
+        """
+        if self.automaton_goto is None:
+            self.build_automaton()
+        match_ends = {}
+        state = 0
+        for i, word_id in enumerate(query_word_ids):
+            while state != 0 and word_id not in self.automaton_goto[state]:
+                state = self.automaton_fail[state]
+            state = self.automaton_goto[state].get(word_id, 0)
+            for value_id in self.automaton_output[state]:
+                match_ends.setdefault(value_id, []).append(i)
+        return match_ends
+
+    def candidate_values(self, similar_word_sets):
+        """
+        find the values each word of which is similar with at least one word of the query, the other values can not be
+        fully matched, so they never add labels to the query
+        :param similar_word_sets: for each word of the query, the set of the ids of the similar words
+        :return: a list of value ids in the order of the click log
+        """
+        hits = {}
+        for word_id in set().union(*similar_word_sets):
+            for value_id, position in self.postings[word_id]:
+                hits.setdefault(value_id, set()).add(position)
+        return sorted(value_id for value_id in hits if len(hits[value_id]) == len(self.value_tokens[value_id]))
+
+
+def string_match(query, logs, algorithm, threshold, exact=False, resolved_words=None, query_cache=None, profile=None):
     """
     label the input query with the predefined attributes
-    :param query: a list of query to be labeled
-    :param logs: a json file path which contains the attributes and the corresponding value
+    :param query: a query string
+    :param logs: dict: {"attribute1": ["value1", "value2", ...], ...} or a Matcher compiled from it
     :param algorithm: select the algorithm of similarity
     :param threshold: the threshold of the similarity algorithm
+    :param exact: if True, a word of the query found in the vocabulary only matches itself and the values made of such
+                  words are found by the Aho-Corasick automaton, the similarity is only used for the other words
+    :param resolved_words: dict: {word: the set returned by Matcher.similar_words}, the similar words resolved for a
+                           batch of queries by Matcher.resolve_words, the other words are looked up here
+    :param query_cache: a QueryCache of the labels of the repeated queries
+    :param profile: a QueryProfile returned by Profiler.start_query, the query is not profiled if it is None
     :return:
         label_list: a list contains the corresponding labels of each word of the input query
         Each element of label_list is a set
     """
+    # compile the logs if the caller doesn't share a compiled one
+    matcher = logs if isinstance(logs, Matcher) else Matcher(logs)
+    if query_cache is not None:
+        key = QueryCache.key(query, algorithm, threshold, exact, matcher.version())
+        returned_label_list = query_cache.get(key)
+        if returned_label_list is None:
+            returned_label_list = string_match(query, matcher, algorithm, threshold, exact, resolved_words,
+                                               profile=profile)
+            query_cache.put(key, returned_label_list)
+        elif profile is not None:
+            profile.count("query_cache_hits")
+            profile.lap("query_cache")
+        return returned_label_list
     # convert the string to list
-    query_list = query.strip("\n").split(" ")
+    query_list = matcher.tokenize(query.strip("\n"))
+    # the similar words in the vocabulary of each word of the query, a repeated word is only looked up once
+    similar_word_cache = {}
+    # the word id of each word of the query, None for the words matched by similarity
+    query_word_ids = [None] * len(query_list)
+    # the similar words of the words matched by similarity in the exact mode
+    fuzzy_word_ids = set()
+    for i, word in enumerate(query_list):
+        if exact:
+            query_word_ids[i] = matcher.word_id(word)
+        if word not in similar_word_cache:
+            if query_word_ids[i] is not None:
+                similar_word_cache[word] = {query_word_ids[i]}
+            elif resolved_words is not None and word in resolved_words:
+                similar_word_cache[word] = resolved_words[word]
+                fuzzy_word_ids.update(similar_word_cache[word])
+            else:
+                similar_word_cache[word] = matcher.similar_words(word, algorithm, threshold)
+                fuzzy_word_ids.update(similar_word_cache[word])
+    similar_word_sets = [similar_word_cache[word] for word in query_list]
+    if profile is not None:
+        profile.lap("similar_words")
     # store the labels in label_list
     label_list = [set() for _ in range(len(query_list))]
     # cache the label_list
@@ -198,63 +1627,73 @@ def string_match(query, logs, algorithm, threshold):
     attribute_set = set()
     # math the longest value flag
     multi_label_flag = 0
-    # visit each attribute in logs
-    for key in logs:
-        # visit each value of the attribute
-        for value in logs[key]:
-            # each value of logs[key] may be composed of two or more words, to match the value, use DP
-            value_list = value.split(" ")
-            # Top down DP
-            # allocate memory
-            # memo = [[0] * (len(value_list) + 1) for _ in range(len(query_list) + 1)]
-            memo = np.zeros((len(value_list) + 1, len(query_list) + 1))
-            # visit each word of the query, from the last one to the first one
+    # only visit the values which may be fully matched by the query
+    value_ids = matcher.candidate_values(similar_word_sets)
+    exact_match_ends = {}
+    if exact:
+        # the values containing a word similar with a fuzzy word of the query go through the DP, the automaton finds
+        # all the other values, which can only be matched by the words found in the vocabulary
+        value_ids = [value_id for value_id in value_ids
+                     if any(word_id in fuzzy_word_ids for word_id in matcher.value_tokens[value_id])]
+        exact_match_ends = matcher.exact_matches(query_word_ids)
+        for value_id in value_ids:
+            exact_match_ends.pop(value_id, None)
+        value_ids = sorted(value_ids + list(exact_match_ends))
+    if profile is not None:
+        profile.count("candidate_values", len(value_ids))
+        profile.lap("candidate_values")
+    for value_id in value_ids:
+        key = matcher.attributes[matcher.value_attributes[value_id]]
+        # each value may be composed of two or more words, to match the value, use DP
+        value_list = matcher.value_tokens[value_id]
+        if value_id in exact_match_ends:
+            match_ends = exact_match_ends[value_id]
+            # label the words of the matches as the DP does: a word is the beginning of the label unless the previous
+            # word of the query matches the previous word of the value
+            for match_end in match_ends:
+                for i in range(match_end - len(value_list) + 1, match_end + 1):
+                    for j in range(0, len(value_list), 1):
+                        if value_list[j] in similar_word_sets[i]:
+                            if i == 0 or j == 0 or value_list[j - 1] not in similar_word_sets[i - 1]:
+                                label_list_memo[i].add("B-" + key)
+                            else:
+                                label_list_memo[i].add("I-" + key)
+        else:
+            # one pass over the query: previous[j] is the length of the matched run ending with the (j-1)-th word of
+            # the value at the previous word of the query, a full match ends where the run reaches len(value_list)
+            previous = [0] * (len(value_list) + 1)
+            current = [0] * (len(value_list) + 1)
+            match_ends = []
             for i in range(0, len(query_list), 1):
-                # visit each word of the attributes[key] from the last one to the first one
                 for j in range(0, len(value_list), 1):
-                    if similarity(query_list[i], value_list[j], algorithm, threshold):
-                        memo[j + 1][i + 1] = memo[j][i] + 1
-                        if memo[j][i] == 0:
-                            # memo[j][i] == 0, so, it is the beginning of the label
+                    if value_list[j] in similar_word_sets[i]:
+                        current[j + 1] = previous[j] + 1
+                        if previous[j] == 0:
+                            # the run starts here, so, it is the beginning of the label
                             label_list_memo[i].add("B-" + key)
                         else:
-                            # memo[j][i] != 0, so, it is not the beginning of the label
+                            # the run continues, so, it is not the beginning of the label
                             label_list_memo[i].add("I-" + key)
-            # for each value, if only part of the value is in the query, discard the label
-            # only update the label_list when the whole value of attribute matches the query
-            # otherwise, do not update the label_list.
-            # we first find the location of the max value and then row_index -1, column_index -1, until we find 0
-            max_value = max(max(row) for row in memo)
-            # in case there are two or more same length matching
-            while max(max(row) for row in memo) == len(value_list):
-                row_index = 0
-                for row in memo:
-                    column_index = 0
-                    for column in row:
-                        # we find the first max_value, assume we have more than one max_value
-                        if column == max_value:
-                            row_index_cache = row_index
-                            column_index_cache = column_index
-                            while True:
-                                # column_index and row_index are at least 1
-                                label_list[column_index_cache - 1] = label_list[column_index_cache - 1].union(label_list_memo[column_index_cache - 1])
-                                # statistic the different labels of the query, longest match function need this info
-                                attribute_set = attribute_set.union(label_list_memo[column_index_cache - 1])
-                                # clear the added value
-                                memo[row_index_cache][column_index_cache] = 0
-                                # move to the left up data
-                                row_index_cache = row_index_cache - 1
-                                column_index_cache = column_index_cache - 1
-                                # if the left up data is zero, we don't need to add the label
-                                if memo[row_index_cache][column_index_cache] == 0:
-                                    break
-                        # check next column
-                        column_index = column_index + 1
-                    # check next row
-                    row_index = row_index + 1
-            # after updating the label_list, clear the label_list_memo
-            for memo_index in range(len(label_list_memo)):
-                label_list_memo[memo_index].clear()
+                    else:
+                        current[j + 1] = 0
+                if current[len(value_list)] == len(value_list):
+                    match_ends.append(i)
+                previous, current = current, previous
+        # for each value, if only part of the value is in the query, discard the label
+        # only update the label_list when the whole value of attribute matches the query
+        # otherwise, do not update the label_list.
+        for match_end in match_ends:
+            # walk the match backward from its last word
+            for i in range(match_end, match_end - len(value_list), -1):
+                label_list[i] = label_list[i].union(label_list_memo[i])
+                # statistic the different labels of the query, longest match function need this info
+                attribute_set = attribute_set.union(label_list_memo[i])
+        # after updating the label_list, clear the label_list_memo
+        for memo_index in range(len(label_list_memo)):
+            label_list_memo[memo_index].clear()
+        if profile is not None:
+            profile.count("matches", len(match_ends))
+            profile.lap_attribute("match_values", key)
     # after finding the matches, the unlabeled parts should be labeled with "O"
     for i in range(len(label_list)):
         # store each word and the corresponding labels in the dictionary
@@ -267,44 +1706,557 @@ def string_match(query, logs, algorithm, threshold):
         # store each word and the corresponding labels in the dictionary
         label_dict[query_list[i]] = label_list[i]
         returned_label_list.append(label_dict)
+    if profile is not None:
+        profile.lap("labels")
     # if need longest_value_match
     if multi_label_flag == 1:
-        longest_match_flag, trash1, trash2 = get_memo_matrix(returned_label_list, attribute_set)
-        if longest_match_flag == 1:
+        if len(pair_attributes(attribute_set)) > 0:
             returned_label_list = longest_value_match(returned_label_list, attribute_set)
+            if profile is not None:
+                profile.count("longest_value_matches")
+                profile.lap("longest_value_match")
     return returned_label_list
 
 
-def query_tagging(query_path, log_path, tagged_query_path, algorithm, threshold):
+def affected_queries(queries, changed_logs, algorithm, threshold, exact=False, normalize=False):
+    """
+    find the queries the labels of which may change with a delta of the click log: a value only labels a query if each
+    of its words is similar with a word of the query, so only the queries with a changed value as a candidate value are
+    affected. the words of the queries are compared with the words of the changed values only
+    :param queries: a list of query strings
+    :param changed_logs: dict: {"attribute1": ["value1", ...], ...}, the values returned by Matcher.apply_delta
+    :param algorithm: the select algorithm to calculate similarity
+    :param threshold: the threshold
+    :param exact: a query word which becomes a word of the vocabulary is matched exactly from now on, so the queries
+                  containing a word of a changed value are affected too
+    :param normalize: the queries and the values are split with normalize_tokens
+    :return: the indexes of the affected queries
+    """
+    changed = Matcher(changed_logs, normalize=normalize)
+    similar_word_cache = {}
+    affected = []
+    for index, query in enumerate(queries):
+        query_list = changed.tokenize(query.strip("\n"))
+        for word in query_list:
+            if word not in similar_word_cache:
+                similar_word_cache[word] = changed.similar_words(word, algorithm, threshold)
+        if exact and any(changed.word_id(word) is not None for word in query_list):
+            affected.append(index)
+        elif len(changed.candidate_values([similar_word_cache[word] for word in query_list])) > 0:
+            affected.append(index)
+    return affected
+
+
+def is_compiled(log_path):
+    """
+    check whether a click log is compiled
+    :param log_path: the path of the click log
+    :return: True if the file starts with COMPILED_MAGIC
+    """
+    with open(log_path, "rb") as log_file:
+        return log_file.read(len(COMPILED_MAGIC)) == COMPILED_MAGIC
+
+
+def load_matcher(log_path, cache=None, normalize=False):
+    """
+    load a json click log and compile it, or memory-map a compiled one
+    :param log_path: the path of the json or compiled click log
+    :param cache: a SimilarityCache shared by the queries
+    :param normalize: split the values and the queries with normalize_tokens, a compiled log must be compiled with the
+                      same normalization
+    :return: a Matcher
+    """
+    if is_compiled(log_path):
+        matcher = Matcher.load_compiled(log_path, cache)
+        if matcher.normalize != normalize:
+            raise ValueError("{} is compiled {} --normalize".format(log_path,
+                                                                    "with" if matcher.normalize else "without"))
+        return matcher
+    with open(log_path) as logs_json:
+        logs = json.load(logs_json)
+    return Matcher(logs, cache, normalize)
+
+
+def compile_log(log_path, compiled_log_path, normalize=False):
+    """
+    convert a json click log into the binary format read by Matcher.load_compiled
+    :param log_path: the path of the json click log
+    :param compiled_log_path: the path of the compiled click log
+    :param normalize: split the values with normalize_tokens
+    """
+    with open(log_path) as logs_json:
+        logs = json.load(logs_json)
+    Matcher(logs, normalize=normalize).save(compiled_log_path)
+
+
+# the state of the worker processes, it is set before the pool is forked so the workers share it copy-on-write
+worker_context = {}
+
+
+def init_worker(context):
+    """
+    set the state of a worker process which is not forked from the main process
+    :param context: dict: {"matcher": ..., "algorithm": ..., "threshold": ..., ...}
+    """
+    worker_context.update(context)
+
+
+class OrderedLabels(set):
+    """
+    the labels of a word returned by a worker process. a set is rebuilt when it is unpickled and may iterate in another
+    order, which changes the text output, so the labels are pickled as a list and keep the iteration order of the set
+    they were copied from. like the labels of a QueryCache, they must not be modified
+    """
+
+    def __init__(self, labels=()):
+        """
+        :param labels: the labels in the order of the original set
+        """
+        self.order = list(labels)
+        super(OrderedLabels, self).__init__(self.order)
+
+    def __iter__(self):
+        return iter(self.order)
+
+    def __repr__(self):
+        return "{" + ", ".join(repr(label) for label in self.order) + "}" if len(self.order) > 0 else "set()"
+
+    def __reduce__(self):
+        return OrderedLabels, (self.order,)
+
+
+def ordered_labels(tagged_query):
+    """
+    :param tagged_query: the labels of a query returned by string_match
+    :return: the same labels, each set of labels is an OrderedLabels so it survives the trip back from a worker process
+    """
+    return [{word: OrderedLabels(labels) if isinstance(labels, set) else labels for word, labels in label_dict.items()}
+            for label_dict in tagged_query]
+
+
+def tag_query(query):
+    """
+    tag a query in a worker process
+    :param query: a query string
+    :return: the labels of the query returned by string_match as OrderedLabels, and its QueryProfile if a Profiler is
+             in the context
+    """
+    profiler = worker_context["profiler"]
+    if profiler is None:
+        return ordered_labels(string_match(query, worker_context["matcher"], worker_context["algorithm"],
+                                           worker_context["threshold"], worker_context["exact"],
+                                           query_cache=worker_context["query_cache"]))
+    profile = profiler.start_query(query)
+    tagged_query = string_match(query, worker_context["matcher"], worker_context["algorithm"],
+                                worker_context["threshold"], worker_context["exact"],
+                                query_cache=worker_context["query_cache"], profile=profile)
+    if profile is not None:
+        profile.finish()
+    profiler.current = None
+    return ordered_labels(tagged_query), profile
+
+
+def process_pool(workers, context):
+    """
+    create a pool of worker processes sharing the context, the workers are forked when the platform supports it so the
+    compiled log is not copied, otherwise the context is pickled to each worker
+    :param workers: the number of worker processes
+    :param context: the state shared by the workers
+    :return: a multiprocessing pool
+    """
+    if "fork" in multiprocessing.get_all_start_methods():
+        worker_context.clear()
+        worker_context.update(context)
+        return multiprocessing.get_context("fork").Pool(workers)
+    return multiprocessing.Pool(workers, init_worker, (context,))
+
+
+def tag_queries(queries, matcher, algorithm, threshold, workers=1, chunk_size=64, exact=False, query_cache=None,
+                profiler=None):
+    """
+    tag the queries in order, the queries are sharded across a process pool when more than one worker is used. the
+    queries are read lazily, at most a few chunks per worker are in flight
+    :param queries: an iterable of query strings
+    :param matcher: the Matcher compiled from the click log
+    :param algorithm: the select algorithm to calculate similarity
+    :param threshold: the threshold
+    :param workers: the number of worker processes, the queries are tagged in this process if it is 1
+    :param chunk_size: the number of queries sent to a worker at a time
+    :param exact: match the words found in the vocabulary exactly, see string_match
+    :param query_cache: a QueryCache of the repeated queries, each worker process fills its own copy
+    :param profiler: a Profiler of the queries, the worker processes return the profiles of their queries
+    :return: a generator of (query, the labels of the query), in the order of the queries
+    """
+    if workers <= 1:
+        for query in queries:
+            if profiler is None:
+                yield query, string_match(query, matcher, algorithm, threshold, exact, query_cache=query_cache)
+                continue
+            profile = profiler.start_query(query)
+            tagged_query = string_match(query, matcher, algorithm, threshold, exact, query_cache=query_cache,
+                                        profile=profile)
+            profiler.finish_query(profile)
+            yield query, tagged_query
+        return
+    context = {"matcher": matcher, "algorithm": algorithm, "threshold": threshold, "exact": exact,
+               "query_cache": query_cache, "profiler": profiler}
+    with process_pool(workers, context) as pool:
+        for batch in batches(queries, 4 * workers * chunk_size):
+            for query, tagged_query in zip(batch, pool.imap(tag_query, batch, chunk_size)):
+                if profiler is not None:
+                    tagged_query, profile = tagged_query
+                    profiler.queries = profiler.queries + 1
+                    profiler.finish_query(profile)
+                yield query, tagged_query
+
+
+def batches(items, batch_size):
+    """
+    split an iterable into lists without reading it all
+    :param items: an iterable
+    :param batch_size: the maximum length of each list
+    :return: a generator of lists
+    """
+    iterator = iter(items)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+
+def open_input(path):
+    """
+    open a text file for lazy reading, "-" reads from stdin
+    :param path: the path of the file or "-"
+    :return: a context manager of the file object
+    """
+    if path == "-":
+        return contextlib.nullcontext(sys.stdin)
+    return open(path)
+
+
+def open_output(path, binary=False):
+    """
+    open a single buffered writer appending to a file, "-" writes to stdout
+    :param path: the path of the file or "-"
+    :param binary: open the file for bytes, see OUTPUT_FORMATS
+    :return: a context manager of the file object
+    """
+    if path == "-":
+        return contextlib.nullcontext(sys.stdout.buffer if binary else sys.stdout)
+    return open(path, "ab" if binary else "a+", buffering=1 << 20)
+
+
+def labels_to_json(tagged_query):
+    """
+    convert the labels returned by string_match to json, each set of labels becomes a sorted list
+    :param tagged_query: [{"word1": {"label1", ...}}, ...], or the lists of labels of StringMatchClick
+    :return: [{"word1": ["label1", ...]}, ...]
+    """
+    return [{word: sorted(labels) if isinstance(labels, (set, frozenset)) else labels
+             for word, labels in word_labels.items()} for word_labels in tagged_query]
+
+
+def label_scores(labels):
+    """
+    flatten the labels of a word
+    :param labels: a set of labels, or the list of "O" and {label: score} of StringMatchClick
+    :return: a list of (label, score), the score is None if the label has no score
+    """
+    if isinstance(labels, (set, frozenset)):
+        return [(label, None) for label in sorted(labels)]
+    pairs = []
+    for item in labels:
+        if isinstance(item, dict):
+            pairs.extend(item.items())
+        else:
+            pairs.append((item, None))
+    return pairs
+
+
+def format_text(batch, index):
+    """
+    :param batch: a list of (query, the labels of the query)
+    :param index: the index of the first query of the batch
+    :return: the text blocks of the queries: "query<index>: <query>", "Tagged Query: <the labels>" and an empty line
+    """
+    return "".join("query{}: {}\nTagged Query: {}\n\n".format(index + offset, query.strip("\n"), tagged_query)
+                   for offset, (query, tagged_query) in enumerate(batch))
+
+
+def format_jsonl(batch, index):
+    """
+    :param batch: a list of (query, the labels of the query)
+    :param index: the index of the first query of the batch
+    :return: a json object {"query": ..., "tagged_query": [{"word1": [labels]}, ...]} per line
+    """
+    return "".join(json.dumps({"query": query.strip("\n"), "tagged_query": labels_to_json(tagged_query)}) + "\n"
+                   for query, tagged_query in batch)
+
+
+def format_conll(batch, index):
+    """
+    :param batch: a list of (query, the labels of the query)
+    :param index: the index of the first query of the batch
+    :return: a line "word<TAB>label1|label2" per word and an empty line after each query, the scores are dropped
+    """
+    lines = []
+    for query, tagged_query in batch:
+        for word_labels in tagged_query:
+            for word, labels in word_labels.items():
+                lines.append(word + "\t" + "|".join(dict.fromkeys(label for label, _ in label_scores(labels))))
+        lines.append("")
+    return "\n".join(lines) + "\n" if len(lines) > 0 else ""
+
+
+# the first bytes of each batch of tagged queries in the columnar format
+TAGGED_MAGIC = b"SMTAGS\x00\x01"
+
+
+def format_columnar(batch, index):
+    """
+    encode a batch of tagged queries as flat columns, the words and the labels are never formatted one by one
+    :param batch: a list of (query, the labels of the query)
+    :param index: the index of the first query of the batch
+    :return: bytes: TAGGED_MAGIC, the length of the json header, the header {"queries": ..., "labels": [...],
+             "sections": {name: [offset, dtype, count]}} and the arrays aligned to 8 bytes, see read_tagged_columns
+    """
+    words = []
+    word_rows = [0]
+    label_ids = {}
+    label_rows = [0]
+    labels_of_words = []
+    scores = []
+    for _, tagged_query in batch:
+        for word_labels in tagged_query:
+            for word, labels in word_labels.items():
+                words.append(word)
+                for label, score in label_scores(labels):
+                    labels_of_words.append(label_ids.setdefault(label, len(label_ids)))
+                    scores.append(np.nan if score is None else score)
+                label_rows.append(len(labels_of_words))
+        word_rows.append(len(words))
+    query_offsets, query_data = StringTable.encode([query.strip("\n") for query, _ in batch])
+    word_offsets, word_data = StringTable.encode(words)
+    arrays = [("query_offsets", query_offsets), ("query_data", query_data),
+              ("word_rows", np.array(word_rows, dtype=np.int64)), ("word_offsets", word_offsets),
+              ("word_data", word_data), ("label_rows", np.array(label_rows, dtype=np.int64)),
+              ("label_ids", np.array(labels_of_words, dtype=np.int32)),
+              ("label_scores", np.array(scores, dtype=np.float64))]
+    sections = {}
+    offset = 0
+    for name, array in arrays:
+        sections[name] = [offset, array.dtype.str, len(array)]
+        offset = offset + (array.nbytes + 7) // 8 * 8
+    header = json.dumps({"queries": len(batch), "labels": list(label_ids), "sections": sections}).encode("utf-8")
+    header = header + b" " * (-len(header) % 8)
+    chunks = [TAGGED_MAGIC, len(header).to_bytes(8, "little"), header]
+    for name, array in arrays:
+        chunks.append(array.tobytes())
+        chunks.append(b"\x00" * (-array.nbytes % 8))
+    return b"".join(chunks)
+
+
+# the formats of the tagged queries, the columnar format is written to a binary file
+OUTPUT_FORMATS = {"text": format_text, "jsonl": format_jsonl, "conll": format_conll, "columnar": format_columnar}
+
+
+def write_tagged_queries(tagged_queries, tagged_query_txt, flush_every=1000, output_format="text"):
+    """
+    write the tagged queries a batch at a time and flush the writer after each batch
+    :param tagged_queries: an iterable of (query, the labels of the query)
+    :param tagged_query_txt: the writer, a binary writer for the columnar format
+    :param flush_every: the number of queries in a batch
+    :param output_format: a key of OUTPUT_FORMATS
+    """
+    format_batch = OUTPUT_FORMATS[output_format]
+    index = 0
+    for batch in batches(tagged_queries, flush_every):
+        tagged_query_txt.write(format_batch(batch, index))
+        tagged_query_txt.flush()
+        index = index + len(batch)
+    tagged_query_txt.flush()
+
+
+def read_tagged_queries(tagged_query_txt, output_format="text"):
+    """
+    read the tagged queries written by write_tagged_queries
+    :param tagged_query_txt: the reader
+    :param output_format: "text" or "jsonl", the labels read from jsonl are lists
+    :return: a generator of (query, the labels of the query)
+    """
+    if output_format == "jsonl":
+        for line in tagged_query_txt:
+            if len(line.strip()) > 0:
+                tagged_query = json.loads(line)
+                yield tagged_query["query"], tagged_query["tagged_query"]
+        return
+    query = None
+    for line in tagged_query_txt:
+        if line.startswith("Tagged Query: "):
+            yield query, ast.literal_eval(line[len("Tagged Query: "):])
+        elif line.startswith("query"):
+            query = line.rstrip("\n").split(": ", 1)[1]
+
+
+def read_tagged_columns(path):
+    """
+    memory-map the batches of tagged queries written in the columnar format, nothing is parsed or copied
+    :param path: the path of the tagged queries
+    :return: a generator of a dict per batch: {"labels": the label names, "queries": a StringTable of the queries,
+             "words": a StringTable of the words of all the queries,
+             "word_rows": the words of the i-th query are word_rows[i]:word_rows[i + 1],
+             "label_rows": the labels of the j-th word are label_rows[j]:label_rows[j + 1] of "label_ids" and
+             "label_scores", the scores are NaN when the labels have no score}
+    """
+    with open(path, "rb") as tagged_query_file:
+        if os.fstat(tagged_query_file.fileno()).st_size == 0:
+            return
+        mapped = mmap.mmap(tagged_query_file.fileno(), 0, access=mmap.ACCESS_READ)
+    start = 0
+    while start < len(mapped):
+        if mapped[start:start + len(TAGGED_MAGIC)] != TAGGED_MAGIC:
+            raise ValueError("{} is not a columnar file of tagged queries at byte {}".format(path, start))
+        header_length = int.from_bytes(mapped[start + len(TAGGED_MAGIC):start + len(TAGGED_MAGIC) + 8], "little")
+        start = start + len(TAGGED_MAGIC) + 8
+        header = json.loads(mapped[start:start + header_length].decode("utf-8"))
+        start = start + header_length
+        arrays = {}
+        end = start
+        for name, (offset, dtype, count) in header["sections"].items():
+            arrays[name] = np.frombuffer(mapped, dtype=np.dtype(dtype), count=count, offset=start + offset)
+            end = max(end, start + offset + (arrays[name].nbytes + 7) // 8 * 8)
+        yield {"queries": StringTable(arrays["query_offsets"], arrays["query_data"]),
+               "words": StringTable(arrays["word_offsets"], arrays["word_data"]),
+               "labels": header["labels"], "word_rows": arrays["word_rows"], "label_rows": arrays["label_rows"],
+               "label_ids": arrays["label_ids"], "label_scores": arrays["label_scores"]}
+        start = end
+
+
+def query_tagging(query_path, log_path, tagged_query_path, algorithm, threshold, cache_size=1000000, cache_path=None,
+                  workers=1, chunk_size=64, flush_every=1000, exact=False, vectorized=False, query_cache_size=100000,
+                  profile=False, profile_trace_path=None, profile_sample_rate=1.0, output_format="text",
+                  normalize=False):
     """
     this function take the log_path and query_list as inputs and write
-    :param query_path: a list of queries
-    :param log_path: click log path
-    :param tagged_query_path: the path of the outputted tagged query
+    :param query_path: a list of queries, "-" reads the queries from stdin
+    :param log_path: click log path, the json click log or the one compiled by compile_log
+    :param tagged_query_path: the path of the outputted tagged query, "-" writes the tagged queries to stdout
     :param algorithm: the select algorithm to calculate similarity
     :param threshold: the threshold
-    :return: write the predicted labels in the tagged_query_path
+    :param cache_size: the maximum number of similarity scores cached across the queries
+    :param cache_path: the similarity cache is loaded from and saved to this json file if it is not None
+    :param workers: the number of worker processes tagging the queries
+    :param chunk_size: the number of queries sent to a worker at a time
+    :param flush_every: the number of queries between two flushes of the output
+    :param exact: match the words found in the vocabulary exactly, see string_match
+    :param vectorized: score each query word against the whole vocabulary with the NumPy kernel
+    :param query_cache_size: the maximum number of queries the labels of which are cached, 0 disables the cache
+    :param profile: time the stages of the queries and count the similarity calls, the candidate values and the
+                    matches, a summary is printed at the end
+    :param profile_trace_path: each profiled query is written to this json lines file if it is not None
+    :param profile_sample_rate: the fraction of the queries which are profiled
+    :param output_format: "text", "jsonl", "conll" or "columnar", see OUTPUT_FORMATS
+    :param normalize: split the values and the queries with normalize_tokens, the labels are given to the normalized
+                      words
+    :return: write the predicted labels in the tagged_query_path, the summary of the Profiler if profile is True
     """
+    # the messages go to stderr when stdout carries the tagged queries
+    message_txt = sys.stderr if tagged_query_path == "-" else sys.stdout
     # test the args
-    print("The selected similarity algorithm is: " + algorithm)
-    print("The selected threshold is: " + str(threshold))
-    # open the log file and load data
+    print("The selected similarity algorithm is: " + algorithm, file=message_txt)
+    print("The selected threshold is: " + str(threshold), file=message_txt)
+    # the profiler is off unless asked, then nothing is timed or counted
+    profiler = Profiler(profile_sample_rate, profile_trace_path) if profile else None
+    started = time.perf_counter()
+    # the similarity scores are shared by all the queries
+    cache = SimilarityCache(cache_size)
+    if cache_path is not None:
+        cache.load(cache_path)
+    if profiler is not None:
+        cache.score_function = profiler.count_calls(cache.score_function)
+    # compile the logs once for all the queries, a compiled log is memory-mapped
+    matcher = load_matcher(log_path, cache, normalize)
+    matcher.vectorized = vectorized
+    if profiler is not None:
+        profiler.add_time("load", time.perf_counter() - started)
+    # the repeated queries are tagged once
+    query_cache = QueryCache(query_cache_size) if query_cache_size > 0 else None
+    # the queries are read lazily and written through a single writer
+    with open_input(query_path) as query_txt, \
+            open_output(tagged_query_path, output_format == "columnar") as tagged_query_txt:
+        tagged_queries = tag_queries(query_txt, matcher, algorithm, threshold, workers, chunk_size, exact, query_cache,
+                                     profiler)
+        write_tagged_queries(tagged_queries, tagged_query_txt, flush_every, output_format)
+    # each worker process fills its own copy of the caches, only the caches of this process are reported and saved
+    if workers <= 1:
+        print(cache.report(), file=message_txt)
+        if query_cache is not None:
+            print(query_cache.report(), file=message_txt)
+    if cache_path is not None:
+        cache.save(cache_path)
+    if profiler is not None:
+        profiler.add_time("total", time.perf_counter() - started)
+        profiler.close()
+        print(profiler.report(), file=message_txt)
+        return profiler.summary()
+
+
+def update_tagging(log_path, delta_path, tagged_query_path, algorithm, threshold, updated_log_path=None, exact=False,
+                   vectorized=False, cache_size=1000000, output_format="text", normalize=False):
+    """
+    apply a delta to the click log and re-tag only the affected queries of a tagged query file
+    :param log_path: the path of the json click log
+    :param delta_path: the path of the json delta: {"add": {"attribute1": ["value1", ...], ...}, "remove": {...}}
+    :param tagged_query_path: the path of the tagged queries written by query_tagging, it is rewritten in place
+    :param algorithm: the select algorithm to calculate similarity
+    :param threshold: the threshold
+    :param updated_log_path: the updated click log is written to this json file if it is not None
+    :param exact: match the words found in the vocabulary exactly, see string_match
+    :param vectorized: score each query word against the whole vocabulary with the NumPy kernel
+    :param cache_size: the maximum number of similarity scores cached across the queries
+    :param output_format: "text" or "jsonl", the format of the tagged queries
+    :param normalize: the tagged queries were tagged with normalize
+    """
+    with open(delta_path) as delta_json:
+        delta = json.load(delta_json)
     with open(log_path) as logs_json:
-        logs = json.load(logs_json)
-    with open(query_path) as query_txt:
-        lines = query_txt.readlines()
-        index = 0
-        for query_list in lines:
-            # print(string_match(query, logs, algorithm, threshold))
-            tagged_query = string_match(query_list, logs, algorithm, threshold)
-            with open(tagged_query_path, "a+") as tagged_query_txt:
-                tagged_query_txt.write("query{}".format(index) + ": " + query_list.strip("\n") + "\n"
-                                       + "Tagged Query: " + str(tagged_query) + "\n" + "\n")
-            index = index + 1
+        matcher = Matcher(json.load(logs_json), SimilarityCache(cache_size), normalize)
+    matcher.vectorized = vectorized
+    changed_logs = matcher.apply_delta(delta)
+    with open(tagged_query_path) as tagged_query_txt:
+        tagged_queries = list(read_tagged_queries(tagged_query_txt, output_format))
+    affected = affected_queries([query for query, _ in tagged_queries], changed_logs, algorithm, threshold, exact,
+                                normalize)
+    for index in affected:
+        query = tagged_queries[index][0]
+        tagged_queries[index] = query, string_match(query, matcher, algorithm, threshold, exact)
+    # the tagged queries are replaced at once, a reader never sees a half-written file
+    with open(tagged_query_path + ".tmp", "w", buffering=1 << 20) as tagged_query_txt:
+        write_tagged_queries(tagged_queries, tagged_query_txt, output_format=output_format)
+    os.replace(tagged_query_path + ".tmp", tagged_query_path)
+    if updated_log_path is not None:
+        with open(updated_log_path, "w") as logs_json:
+            json.dump(matcher.to_logs(), logs_json)
+    print("Re-tagged {} of {} queries".format(len(affected), len(tagged_queries)))
 
 
 def main():
 
+    # StringMatch.py compile log_path compiled_log_path
+    if len(sys.argv) > 1 and sys.argv[1] == "compile":
+        compile_parser = argparse.ArgumentParser(prog="StringMatch.py compile")
+        compile_parser.add_argument("log_path", type=str, help="the path of the json click log")
+        compile_parser.add_argument("compiled_log_path", type=str,
+                                    help="the path of the compiled click log, "
+                                         "it can be used as the log_path of tagging")
+        compile_parser.add_argument("--normalize", action="store_true",
+                                    help="normalize the values, the compiled log is tagged with --normalize")
+        compile_args = compile_parser.parse_args(sys.argv[2:])
+        compile_log(compile_args.log_path, compile_args.compiled_log_path, compile_args.normalize)
+        return
+
     # the threshold is float between [0.0, 1]
     def restricted_float(x):
         x = float(x)
@@ -312,18 +2264,77 @@ def main():
             raise argparse.ArgumentTypeError("%r not in range [0.0, 1.0]" % (x,))
         return x
 
+    # StringMatch.py update log_path delta_path tagged_query_path
+    if len(sys.argv) > 1 and sys.argv[1] == "update":
+        update_parser = argparse.ArgumentParser(prog="StringMatch.py update")
+        update_parser.add_argument("log_path", type=str, help="the path of the json click log")
+        update_parser.add_argument("delta_path", type=str,
+                                   help="the path of the json delta: {\"add\": {...}, \"remove\": {...}}")
+        update_parser.add_argument("tagged_query_path", type=str,
+                                   help="the path of the tagged queries, the affected queries are re-tagged in place")
+        update_parser.add_argument("--updated_log_path", default=None, type=str,
+                                   help="write the updated click log to this json file, it can be the log_path")
+        update_parser.add_argument("--algorithm", default="jaro-winkler", type=str, choices=["trigram", "jaro-winkler"],
+                                   help="the algorithm the tagged queries were tagged with")
+        update_parser.add_argument("--threshold", default=0.95, type=restricted_float,
+                                   help="the threshold the tagged queries were tagged with")
+        update_parser.add_argument("--exact", action="store_true", help="the tagged queries were tagged with --exact")
+        update_parser.add_argument("--vectorized", action="store_true",
+                                   help="score each query word against the whole vocabulary at once with NumPy")
+        update_parser.add_argument("--output_format", default="text", type=str, choices=["text", "jsonl"],
+                                   help="the format of the tagged queries")
+        update_parser.add_argument("--normalize", action="store_true",
+                                   help="the tagged queries were tagged with --normalize")
+        update_args = update_parser.parse_args(sys.argv[2:])
+        update_tagging(update_args.log_path, update_args.delta_path, update_args.tagged_query_path,
+                       update_args.algorithm, update_args.threshold, update_args.updated_log_path, update_args.exact,
+                       update_args.vectorized, output_format=update_args.output_format,
+                       normalize=update_args.normalize)
+        return
+
     # command-line parsing
     parser = argparse.ArgumentParser()
     parser.add_argument("query_path", type=str, help="the path of the input query file, " +
-                        "the query file is of txt format each line of which is a query")
-    parser.add_argument("log_path", type=str, help="the path of click")
+                        "the query file is of txt format each line of which is a query, - reads from stdin")
+    parser.add_argument("log_path", type=str, help="the path of click log, json or compiled by the compile command")
     parser.add_argument("tagged_query_path", type=str,
-                        help="the path of the outputted tagged query the format of which is txt")
+                        help="the path of the outputted tagged query the format of which is txt, - writes to stdout")
     parser.add_argument("--algorithm", default="jaro-winkler", type=str, choices=["trigram", "jaro-winkler"],
                         help="select the algorithm to calculate similarity: trigram or jaro-winkler")
 
     parser.add_argument("--threshold", default=0.95, type=restricted_float,
                         help="if the similarity score of two words >= threshold, the two words are considered same")
+    parser.add_argument("--cache_size", default=1000000, type=int,
+                        help="the maximum number of similarity scores cached across the queries, 0 disables the cache")
+    parser.add_argument("--cache_path", default=None, type=str,
+                        help="load the similarity cache from this json file and save it back after tagging")
+    parser.add_argument("--workers", default=1, type=int,
+                        help="the number of worker processes tagging the queries")
+    parser.add_argument("--chunk_size", default=64, type=int,
+                        help="the number of queries sent to a worker process at a time")
+    parser.add_argument("--flush_every", default=1000, type=int,
+                        help="the number of tagged queries written between two flushes of the output")
+    parser.add_argument("--exact", action="store_true",
+                        help="a query word found in the click log only matches itself, the values made of such words " +
+                        "are found in one pass by an Aho-Corasick automaton, the other words are matched by similarity")
+    parser.add_argument("--vectorized", action="store_true",
+                        help="score each query word against the whole vocabulary at once with NumPy")
+    parser.add_argument("--query_cache_size", default=100000, type=int,
+                        help="the maximum number of queries the labels of which are cached, 0 disables the cache")
+    parser.add_argument("--profile", action="store_true",
+                        help="time the stages of the queries, count the similarity calls, the candidate values and " +
+                        "the matches, and print a summary at the end")
+    parser.add_argument("--profile_trace_path", default=None, type=str,
+                        help="write each profiled query to this json lines file")
+    parser.add_argument("--profile_sample_rate", default=1.0, type=restricted_float,
+                        help="the fraction of the queries which are profiled")
+    parser.add_argument("--output_format", default="text", type=str, choices=list(OUTPUT_FORMATS),
+                        help="text: the labels of each query as a python literal, jsonl: a json object per query, " +
+                        "conll: a word and its labels per line, columnar: binary batches of flat arrays")
+    parser.add_argument("--normalize", action="store_true",
+                        help="case fold the queries and the values, split them on the whitespaces and the " +
+                        "punctuation and write the units of the numbers the same way, " +
+                        "e.g. 65in, 65 inches and 65\" are 65 inch")
     args = parser.parse_args()
 
     # for test
@@ -331,7 +2342,10 @@ def main():
     # args.log_path = "special_case.json"
     # args.tagged_query_path = "special_case_query_tagged.txt"
     #
-    query_tagging(args.query_path, args.log_path, args.tagged_query_path, args.algorithm, args.threshold)
+    query_tagging(args.query_path, args.log_path, args.tagged_query_path, args.algorithm, args.threshold,
+                  args.cache_size, args.cache_path, args.workers, args.chunk_size, args.flush_every,
+                  args.exact, args.vectorized, args.query_cache_size, args.profile, args.profile_trace_path,
+                  args.profile_sample_rate, args.output_format, args.normalize)
     # test get_memo_matrix
     # print(longest_value_match([{"t1": {"B-CO", "B-PT", "B-PD"}}, {"t2": {"B-PD", "I-CO"}}, {"t3": {"I-CO", "B-PT"}},
     #                            {"t4": {"I-CO"}}, {"t5": {"B-PT"}}, {"t6": {"I-PT"}}, {"t7": {"O"}}, {"t8": {"B-CO"}}],
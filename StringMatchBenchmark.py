@@ -0,0 +1,343 @@
+"""
+This program benchmarks the query tagging of StringMatch.py and StringMatchClick.py on the bundled data and on synthetic
+click logs and queries, the results are saved as json to compare the versions
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import resource
+import tempfile
+import itertools
+import contextlib
+import multiprocessing
+
+# the attributes of the synthetic click logs
+ATTRIBUTES = ["Brand", "Category", "ModelName", "ScreenSize", "Storage", "Price", "Color", "Feature"]
+SYLLABLES = ["ap", "ple", "sam", "sung", "so", "ny", "len", "ovo", "de", "ll", "mac", "book", "pro", "air", "gal",
+             "axy", "pix", "el", "watch", "pad", "tab", "fit", "bit", "go", "cam", "era", "ro", "ku", "xbox", "play",
+             "sta", "tion", "char", "ger", "ca", "ble", "head", "phone", "ear", "bud", "lap", "top", "mon", "itor",
+             "key"]
+UNITS = ["in", "inch", "gb", "tb", "mp", "hz"]
+
+
+def zipf_sampler(population, rng, exponent=1.1):
+    """
+    draw from a population with a Zipf distribution over its order, the first items are the most frequent
+    :param population: a list
+    :param rng: a random.Random
+    :param exponent: the exponent of the Zipf distribution
+    :return: a function drawing k items
+    """
+    cum_weights = list(itertools.accumulate(1.0 / (rank ** exponent) for rank in range(1, len(population) + 1)))
+    return lambda k=1: rng.choices(population, cum_weights=cum_weights, k=k)
+
+
+def make_tokens(count, rng):
+    """
+    make a vocabulary of word-like tokens, a tenth of them are sizes and prices
+    :param count: the number of tokens
+    :param rng: a random.Random
+    :return: a list of distinct tokens
+    """
+    tokens = []
+    seen = set()
+    while len(tokens) < count:
+        if rng.random() < 0.1:
+            number = rng.choice([4, 8, 13, 15, 27, 32, 55, 65, 75, 128, 256, 500, 1000])
+            token = "$" + str(number) if rng.random() < 0.3 else str(number) + rng.choice(UNITS)
+        else:
+            token = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 3)))
+        if token not in seen:
+            seen.add(token)
+            tokens.append(token)
+    return tokens
+
+
+def typo(word, rng):
+    """
+    apply a random deletion, insertion, substitution or transposition to a word
+    :param word: a word
+    :param rng: a random.Random
+    :return: the misspelled word
+    """
+    if len(word) < 3:
+        return word
+    position = rng.randrange(1, len(word) - 1)
+    edit = rng.randrange(4)
+    if edit == 0:
+        return word[:position] + word[position + 1:]
+    if edit == 1:
+        return word[:position] + rng.choice("abcdefghijklmnopqrstuvwxyz") + word[position:]
+    if edit == 2:
+        return word[:position] + rng.choice("abcdefghijklmnopqrstuvwxyz") + word[position + 1:]
+    return word[:position - 1] + word[position] + word[position - 1] + word[position + 1:]
+
+
+def generate_dataset(data_dir, scale=1, seed=0):
+    """
+    write a synthetic click log, query file and query and click log file. the tokens of the values and the queries and
+    the repetitions of the queries follow Zipf distributions, a tenth of the query words are misspelled
+    :param data_dir: the directory of the files
+    :param scale: the size of the data, the number of values and queries grow linearly with it
+    :param seed: the seed of the random generator
+    :return: dict: {"log_path": ..., "query_path": ..., "query_log_path": ...}
+    """
+    rng = random.Random(seed)
+    tokens = make_tokens(2000 * scale, rng)
+    draw_token = zipf_sampler(tokens, rng)
+    # the click log: each attribute has its own values of 1 to 3 tokens
+    logs = {}
+    values = []
+    for key in ATTRIBUTES:
+        attribute_values = list(dict.fromkeys(" ".join(draw_token(rng.choices([1, 2, 3], [6, 3, 1])[0]))
+                                              for _ in range(100 * scale)))
+        logs[key] = attribute_values
+        values.extend((key, value) for value in attribute_values)
+    draw_value = zipf_sampler(values, rng)
+    # the distinct queries mix values and other tokens, the query stream repeats them with a power law
+    distinct_queries = []
+    for _ in range(500 * scale):
+        words = []
+        for _ in range(rng.choices([1, 2, 3], [5, 4, 1])[0]):
+            words.extend(draw_value()[0][1].split(" ") if rng.random() < 0.6 else draw_token())
+        distinct_queries.append(" ".join(typo(word, rng) if rng.random() < 0.1 else word for word in words))
+    queries = zipf_sampler(distinct_queries, rng, 0.9)(1000 * scale)
+    # the click log of each distinct query: the values of its words and some popular values, the clicks follow Zipf
+    first_token_values = {}
+    for key, value in values:
+        first_token_values.setdefault(value.split(" ")[0], []).append((key, value))
+    query_logs = {}
+    for query in distinct_queries:
+        query_values = [value for value in values[:20 * scale] if rng.random() < 0.5]
+        for word in dict.fromkeys(query.split(" ")):
+            query_values.extend(first_token_values.get(word, [])[:10])
+        rng.shuffle(query_values)
+        query_log = {}
+        for rank, (key, value) in enumerate(query_values, 1):
+            query_log.setdefault(key, []).append({value: max(1, int(1000 / rank ** 1.1))})
+        query_logs[query] = query_log
+    paths = {"log_path": os.path.join(data_dir, "synthetic_{}_click_log.json".format(scale)),
+             "query_path": os.path.join(data_dir, "synthetic_{}_query.txt".format(scale)),
+             "query_log_path": os.path.join(data_dir, "synthetic_{}_query_click_log.jsonl".format(scale))}
+    with open(paths["log_path"], "w") as log_json:
+        json.dump(logs, log_json)
+    with open(paths["query_path"], "w") as query_txt:
+        query_txt.write("".join(query + "\n" for query in queries))
+    # the query stream of StringMatchClick in the jsonl log format, a query may repeat but the keys of a json object
+    # must be unique, so each query is an object of its own line
+    with open(paths["query_log_path"], "w") as query_log_json:
+        query_log_json.write("".join(json.dumps({query: query_logs[query]}) + "\n" for query in queries))
+    return paths
+
+
+def percentile(values, q):
+    """
+    the nearest-rank percentile
+    :param values: a sorted list of numbers
+    :param q: the percentile between 0 and 100
+    :return: the smallest value which is not less than q percent of the values, 0.0 if there is no value
+    """
+    if len(values) == 0:
+        return 0.0
+    return values[max(0, min(len(values) - 1, int(-(-q * len(values) // 100)) - 1))]
+
+
+def peak_rss_mb():
+    """
+    :return: the peak resident set size of this process in MiB, ru_maxrss is in KiB on Linux and in bytes on macOS
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+
+
+def run_case(case):
+    """
+    run query_tagging of a script on a dataset in this process and measure it. the similarity function is wrapped to
+    count its calls, and write_tagged_queries is wrapped to time each query as the lazy tagging yields it
+    :param case: dict: {"script": ..., "paths": ..., "algorithm": ..., "threshold": ..., "options": {...}}
+    :return: dict: the measures of the run, and the stages measured by the Profiler if the options turn it on
+    """
+    import StringMatch
+    import StringMatchClick
+    module = StringMatch if case["script"] == "StringMatch" else StringMatchClick
+    calls = [0]
+    latencies = []
+    if module is StringMatch:
+        score_function = StringMatch.similarity_score
+
+        def counted_similarity(w1, w2, algorithm):
+            calls[0] = calls[0] + 1
+            return score_function(w1, w2, algorithm)
+        StringMatch.similarity_score = counted_similarity
+    else:
+        score_function = StringMatchClick.similarity
+
+        def counted_similarity(w1, w2, algorithm):
+            calls[0] = calls[0] + 1
+            return score_function(w1, w2, algorithm)
+        StringMatchClick.similarity = counted_similarity
+    write_tagged_queries = module.write_tagged_queries
+
+    def timed_write(tagged_queries, tagged_query_txt, *args, **kwargs):
+        def timed():
+            last = time.perf_counter()
+            for tagged_query in tagged_queries:
+                now = time.perf_counter()
+                latencies.append(now - last)
+                yield tagged_query
+                last = time.perf_counter()
+        write_tagged_queries(timed(), tagged_query_txt, *args, **kwargs)
+    module.write_tagged_queries = timed_write
+    paths = case["paths"]
+    output_path = os.path.join(case["output_dir"], "tagged_{}.txt".format(os.getpid()))
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        if module is StringMatch:
+            profile = module.query_tagging(paths["query_path"], paths["log_path"], output_path, case["algorithm"],
+                                           case["threshold"], **case["options"])
+        else:
+            profile = module.query_tagging(paths["query_log_path"], output_path, case["algorithm"], case["threshold"],
+                                           **dict(case["options"], log_format="jsonl"))
+    seconds = time.perf_counter() - start
+    os.remove(output_path)
+    latencies.sort()
+    # the stages of the queries are reported when the options turn the profiler on
+    if profile is not None:
+        profile = {"seconds": profile["seconds"], "counters": profile["counters"],
+                   "slowest_attributes": profile["slowest_attributes"]}
+    return {"profile": profile, "queries": len(latencies), "seconds": seconds,
+            "queries_per_second": len(latencies) / seconds if seconds > 0 else 0.0,
+            "latency_ms": {"mean": sum(latencies) / len(latencies) * 1000 if len(latencies) > 0 else 0.0,
+                           "p50": percentile(latencies, 50) * 1000, "p90": percentile(latencies, 90) * 1000,
+                           "p99": percentile(latencies, 99) * 1000, "max": percentile(latencies, 100) * 1000},
+            "peak_rss_mb": peak_rss_mb(), "similarity_calls": calls[0]}
+
+
+def run_isolated(case):
+    """
+    run a case in a fresh interpreter, so its peak memory and caches are its own
+    :param case: see run_case
+    :return: the measures of run_case
+    """
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(run_case, (case,))
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    print the change of the throughput of each case since a baseline
+    :param results: the results of this run
+    :param baseline: the results of a previous run
+    :param tolerance: a case is reported as a regression if its throughput drops by more than this ratio
+    :return: the number of regressions
+    """
+    def case_key(case):
+        return case["script"], case["dataset"], case["algorithm"], case["threshold"], json.dumps(case["options"])
+    baseline_cases = {case_key(case): case for case in baseline["cases"]}
+    regressions = 0
+    for case in results["cases"]:
+        old_case = baseline_cases.get(case_key(case))
+        if old_case is None or old_case["queries_per_second"] == 0:
+            continue
+        ratio = case["queries_per_second"] / old_case["queries_per_second"]
+        flag = ""
+        if ratio < 1 - tolerance:
+            regressions = regressions + 1
+            flag = "  REGRESSION"
+        print("{} {} {} {}: {:.1f} -> {:.1f} queries/s ({:+.1%}){}".format(
+            case["script"], case["dataset"], case["algorithm"], case["threshold"], old_case["queries_per_second"],
+            case["queries_per_second"], ratio - 1, flag))
+    return regressions
+
+
+def benchmark(output_path, scales=(1,), algorithms=("trigram", "jaro-winkler"), thresholds=(0.8, 0.95),
+              scripts=("StringMatch", "StringMatchClick"), bundled=True, options=None, data_dir=None, seed=0,
+              label=None):
+    """
+    run every combination of script, dataset, algorithm and threshold and save the results
+    :param output_path: the path of the json results
+    :param scales: the scales of the synthetic datasets
+    :param algorithms: the algorithms to calculate similarity
+    :param thresholds: the thresholds
+    :param scripts: "StringMatch" and/or "StringMatchClick"
+    :param bundled: also run StringMatch on bestbuy_query.txt and bestbuy_click_log.json
+    :param options: dict: the other keyword arguments of query_tagging, e.g. {"exact": True}
+    :param data_dir: the synthetic data is written to and kept in this directory, a temporary one if it is None
+    :param seed: the seed of the synthetic data
+    :param label: a name of the benchmarked version, e.g. a git commit
+    :return: the results
+    """
+    options = options or {}
+    results = {"label": label, "python": platform.python_version(), "platform": platform.platform(),
+               "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "cases": []}
+    with contextlib.ExitStack() as stack:
+        if data_dir is None:
+            data_dir = stack.enter_context(tempfile.TemporaryDirectory())
+        os.makedirs(data_dir, exist_ok=True)
+        datasets = []
+        if bundled and "StringMatch" in scripts:
+            directory = os.path.dirname(os.path.abspath(__file__))
+            datasets.append(("bestbuy", {"log_path": os.path.join(directory, "bestbuy_click_log.json"),
+                                         "query_path": os.path.join(directory, "bestbuy_query.txt")}))
+        for scale in scales:
+            datasets.append(("synthetic_{}".format(scale), generate_dataset(data_dir, scale, seed)))
+        cases = itertools.product(datasets, scripts, algorithms, thresholds)
+        for (dataset, paths), script, algorithm, threshold in cases:
+            if script == "StringMatchClick" and "query_log_path" not in paths:
+                continue
+            case = {"script": script, "dataset": dataset, "algorithm": algorithm, "threshold": threshold,
+                    "options": options}
+            measures = run_isolated(dict(case, paths=paths, output_dir=data_dir))
+            case.update(measures)
+            results["cases"].append(case)
+            print("{} {} {} {}: {} queries, {:.1f} queries/s, p50 {:.3f} ms, p99 {:.3f} ms, peak RSS {:.1f} MiB, "
+                  "{} similarity calls".format(script, dataset, algorithm, threshold, case["queries"],
+                                               case["queries_per_second"], case["latency_ms"]["p50"],
+                                               case["latency_ms"]["p99"], case["peak_rss_mb"],
+                                               case["similarity_calls"]))
+    with open(output_path, "w") as results_json:
+        json.dump(results, results_json, indent=2)
+    return results
+
+
+def main():
+    # command-line parsing
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output_path", type=str, help="the path of the json results")
+    parser.add_argument("--scales", default=[1], type=int, nargs="+",
+                        help="the scales of the synthetic datasets, scale 1 has 800 values and 1000 queries")
+    parser.add_argument("--algorithms", default=["trigram", "jaro-winkler"], nargs="+",
+                        choices=["trigram", "jaro-winkler"], help="the algorithms to calculate similarity")
+    parser.add_argument("--thresholds", default=[0.8, 0.95], type=float, nargs="+", help="the thresholds")
+    parser.add_argument("--scripts", default=["StringMatch", "StringMatchClick"], nargs="+",
+                        choices=["StringMatch", "StringMatchClick"], help="the scripts to benchmark")
+    parser.add_argument("--no_bundled", action="store_true",
+                        help="skip bestbuy_query.txt and bestbuy_click_log.json")
+    parser.add_argument("--options", default="{}", type=json.loads,
+                        help="the other keyword arguments of query_tagging as json, e.g. '{\"vectorized\": true}'")
+    parser.add_argument("--data_dir", default=None, type=str,
+                        help="write the synthetic data to this directory and keep it")
+    parser.add_argument("--seed", default=0, type=int, help="the seed of the synthetic data")
+    parser.add_argument("--label", default=None, type=str, help="a name of the benchmarked version")
+    parser.add_argument("--baseline", default=None, type=str,
+                        help="the json results of a previous run, the changes of the throughput are printed")
+    parser.add_argument("--tolerance", default=0.1, type=float,
+                        help="a drop of the throughput beyond this ratio of the baseline is a regression")
+    args = parser.parse_args()
+
+    results = benchmark(args.output_path, args.scales, args.algorithms, args.thresholds, args.scripts,
+                        not args.no_bundled, args.options, args.data_dir, args.seed, args.label)
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_json:
+            baseline = json.load(baseline_json)
+        if compare(results, baseline, args.tolerance) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,9 +3,16 @@ tag each query using the corresponding click log
 """
 
 import json
-import numpy as np
+import heapq
+import hashlib
 import argparse
 from pyjarowinkler import distance  # pip install pyjarowinkler
+import sys
+import os
+import time
+from StringMatch import SimilarityCache, QueryCache, Profiler, jaro_winkler_reachable, process_pool, worker_context, \
+    batches, open_input, open_output, write_tagged_queries, read_tagged_queries, similarity_matrix, OUTPUT_FORMATS, \
+    normalize_tokens, ordered_labels
 
 
 def trigram(word):
@@ -45,7 +52,17 @@ def similarity(w1, w2, algorithm):
     return score
 
 
-def string_match(query, logs, algorithm, threshold):
+def log_version(logs):
+    """
+    a digest of the click log of a query, the order of the attributes and the values matters as it orders the labels
+    :param logs: dict:{"attribute1":[{"value1": click times}, ...], ...}
+    :return: a hex string
+    """
+    return hashlib.sha1(json.dumps(logs).encode("utf-8")).hexdigest()
+
+
+def string_match(query, logs, algorithm, threshold, cache=None, vectorized=False, query_cache=None, top_k=None,
+                 aggregate=False, profile=None, normalize=False):
     """
     label the input query with the predefined attributes
     :param query: a query string
@@ -54,80 +71,140 @@ def string_match(query, logs, algorithm, threshold):
                        ...}
     :param algorithm: select the algorithm of similarity
     :param threshold: the threshold of the similarity algorithm
+    :param cache: a SimilarityCache shared by the queries, the scores are not cached if it is None
+    :param vectorized: score the words of the query against all the words of the logs at once with NumPy
+    :param query_cache: a QueryCache of the labels of the queries repeated with the same click log
+    :param top_k: if not None, only the top_k labels of each word ranked by the weighted similarity score are returned,
+                  the values are visited in descending order of click times and the visit stops once no remaining value
+                  can beat the top_k-th score of every word, as the similarity score is at most 1
+    :param aggregate: sum the weighted similarity scores of each label of each word instead of listing the label of
+                      each match, the labels are ranked by the sums, all the values are visited
+    :param profile: a QueryProfile returned by Profiler.start_query, the query is not profiled if it is None
+    :param normalize: split the query and the values with StringMatch.normalize_tokens instead of on the spaces, the
+                      labels are given to the normalized words
     :return:
         label_list: a list contains the corresponding labels of each word of the input query
         Each element of label_list is a set
+        with top_k or aggregate, each element of label_list is a list of {label: score} in descending order of score
     """
+    if query_cache is not None:
+        key = QueryCache.key(query, algorithm, threshold, log_version(logs), top_k, aggregate, normalize)
+        returned_label_list = query_cache.get(key)
+        if returned_label_list is None:
+            returned_label_list = string_match(query, logs, algorithm, threshold, cache, vectorized, None, top_k,
+                                               aggregate, profile, normalize)
+            query_cache.put(key, returned_label_list)
+        elif profile is not None:
+            profile.count("query_cache_hits")
+            profile.lap("query_cache")
+        return returned_label_list
     # convert the string to list
-    query_list = query.strip("\n").split(" ")
+    query_list = normalize_tokens(query.strip("\n")) if normalize else query.strip("\n").split(" ")
     # store the labels in label_list
     label_list = [[] for _ in range(len(query_list))]
+    # rank the labels of each word: a min-heap of (score, -arrival, label) of the top_k labels, or the summed scores
+    ranked = top_k is not None or aggregate
+    ranked_labels = [[] if top_k is not None and not aggregate else {} for _ in range(len(query_list))]
+    arrival = 0
     # cache the label_list
     label_list_memo = [dict() for _ in range(len(query_list))]
     # the final returned label list
     returned_label_list = []
-    # visit each attribute in logs
-    for key in logs:
-        # visit each value of the attribute
-        for value in logs[key]:
-            # each value is a dict in which there is only a pair of key and value we use the key_name to calculate the
-            # similarity score, and the value (click_time) to weight the score
-            key_name = list(value.keys())[0]
-            click_time = value[key_name]
-            # each value of logs[key] may be composed of two or more words, to match the value, use DP
-            value_list = key_name.split(" ")
-            # Top down DP
-            # allocate memory
-            # memo = [[0] * (len(value_list) + 1) for _ in range(len(query_list) + 1)]
-            memo = np.zeros((len(value_list) + 1, len(query_list) + 1))
-            # weighted similarity score memo
-            # visit each word of the query, from the last one to the first one
-            for i in range(0, len(query_list), 1):
-                # visit each word of the attributes[key] from the last one to the first one
-                for j in range(0, len(value_list), 1):
+    if vectorized:
+        # the score matrix of the distinct words of the query and the distinct words of the values
+        query_rows = {word: row for row, word in enumerate(dict.fromkeys(query_list))}
+        value_columns = {}
+        for key in logs:
+            for value in logs[key]:
+                key_name = list(value.keys())[0]
+                for word in normalize_tokens(key_name) if normalize else key_name.split(" "):
+                    value_columns.setdefault(word, len(value_columns))
+        scores = similarity_matrix(list(query_rows), list(value_columns), algorithm).tolist()
+        if profile is not None:
+            profile.lap("similarity_matrix")
+    # visit each value of each attribute in logs
+    attribute_values = [(key, value) for key in logs for value in logs[key]]
+    if ranked:
+        # the values with the most clicks first, the ties stay in the order of the logs
+        attribute_values.sort(key=lambda attribute_value: -list(attribute_value[1].values())[0])
+    for key, value in attribute_values:
+        # each value is a dict in which there is only a pair of key and value we use the key_name to calculate the
+        # similarity score, and the value (click_time) to weight the score
+        key_name = list(value.keys())[0]
+        click_time = value[key_name]
+        # the weighted score of this value and the next ones is at most click_time, a tie never beats a kept label
+        if top_k is not None and not aggregate and all(len(heap) >= top_k and heap[0][0] >= click_time
+                                                       for heap in ranked_labels):
+            break
+        if profile is not None:
+            profile.count("values")
+        # each value of logs[key] may be composed of two or more words, to match the value, use DP
+        value_list = normalize_tokens(key_name) if normalize else key_name.split(" ")
+        # a value of punctuation only has no normalized word, it matches nothing
+        if len(value_list) == 0:
+            continue
+        # one pass over the query: previous[j] is the length of the matched run ending with the (j-1)-th word of
+        # the value at the previous word of the query, a full match ends where the run reaches len(value_list)
+        previous = [0] * (len(value_list) + 1)
+        current = [0] * (len(value_list) + 1)
+        match_ends = []
+        for i in range(0, len(query_list), 1):
+            # visit each word of the attributes[key]
+            for j in range(0, len(value_list), 1):
+                current[j + 1] = 0
+                if vectorized:
+                    similarity_score = scores[query_rows[query_list[i]]][value_columns[value_list[j]]]
+                # skip the pairs the jaro-winkler score of which can not reach the threshold
+                elif algorithm == "jaro-winkler" and not jaro_winkler_reachable(query_list[i], value_list[j],
+                                                                                threshold):
+                    continue
+                elif cache is None:
                     similarity_score = similarity(query_list[i], value_list[j], algorithm)
-                    if similarity_score >= threshold:
-                        weighted_similarity_score = similarity_score*click_time
-                        memo[j + 1][i + 1] = memo[j][i] + 1
-                        if memo[j][i] == 0:
-                            # memo[j][i] == 0, so, it is the beginning of the label
-                            label_list_memo[i]["B-" + key] = weighted_similarity_score
-                        else:
-                            # memo[j][i] != 0, so, it is not the beginning of the label
-                            label_list_memo[i]["I-" + key] = weighted_similarity_score
-            # for each value, if only part of the value is in the query, discard the label
-            # only update the label_list when the whole value of attribute matches the query
-            # otherwise, do not update the label_list.
-            # we first find the location of the max value and then row_index -1, column_index -1, until we find 0
-            max_value = max(max(row) for row in memo)
-            # in case there are two or more same length matching
-            while max(max(row) for row in memo) == len(value_list):
-                row_index = 0
-                for row in memo:
-                    column_index = 0
-                    for column in row:
-                        # we find the first max_value, assume we have more than one max_value
-                        if column == max_value:
-                            row_index_cache = row_index
-                            column_index_cache = column_index
-                            while True:
-                                # column_index and row_index are at least 1
-                                label_list[column_index_cache - 1].append(label_list_memo[column_index_cache - 1].copy())
-                                # clear the added value
-                                memo[row_index_cache][column_index_cache] = 0
-                                # move to the left up data
-                                row_index_cache = row_index_cache - 1
-                                column_index_cache = column_index_cache - 1
-                                # if the left up data is zero, we don't need to add the label
-                                if memo[row_index_cache][column_index_cache] == 0:
-                                    break
-                        # check next column
-                        column_index = column_index + 1
-                    # check next row
-                    row_index = row_index + 1
-            # after updating the label_list, clear the label_list_memo
-            for memo_index in range(len(label_list_memo)):
-                label_list_memo[memo_index].clear()
+                else:
+                    similarity_score = cache.score(query_list[i], value_list[j], algorithm)
+                if similarity_score >= threshold:
+                    weighted_similarity_score = similarity_score*click_time
+                    current[j + 1] = previous[j] + 1
+                    if previous[j] == 0:
+                        # the run starts here, so, it is the beginning of the label
+                        label_list_memo[i]["B-" + key] = weighted_similarity_score
+                    else:
+                        # the run continues, so, it is not the beginning of the label
+                        label_list_memo[i]["I-" + key] = weighted_similarity_score
+            if current[len(value_list)] == len(value_list):
+                match_ends.append(i)
+            previous, current = current, previous
+        # for each value, if only part of the value is in the query, discard the label
+        # only update the label_list when the whole value of attribute matches the query
+        # otherwise, do not update the label_list.
+        for match_end in match_ends:
+            # walk the match backward from its last word
+            for i in range(match_end, match_end - len(value_list), -1):
+                if not ranked:
+                    label_list[i].append(label_list_memo[i].copy())
+                    continue
+                for label, weighted_similarity_score in label_list_memo[i].items():
+                    if aggregate:
+                        ranked_labels[i][label] = ranked_labels[i].get(label, 0) + weighted_similarity_score
+                    else:
+                        arrival = arrival + 1
+                        heapq.heappush(ranked_labels[i], (weighted_similarity_score, -arrival, label))
+                        if len(ranked_labels[i]) > top_k:
+                            heapq.heappop(ranked_labels[i])
+        # after updating the label_list, clear the label_list_memo
+        for memo_index in range(len(label_list_memo)):
+            label_list_memo[memo_index].clear()
+        if profile is not None:
+            profile.count("matches", len(match_ends))
+            profile.lap_attribute("match_values", key)
+    if ranked:
+        for i in range(len(label_list)):
+            if aggregate:
+                # the ties stay in the order of their first match
+                scores = sorted(ranked_labels[i].items(), key=lambda label_score: -label_score[1])
+            else:
+                scores = [(label, score) for score, _, label in sorted(ranked_labels[i], reverse=True)]
+            label_list[i] = [{label: score} for label, score in scores[:top_k]]
     # after finding the matches, the unlabeled parts should be labeled with "O"
     for i in range(len(label_list)):
         # store each word and the corresponding labels in the dictionary
@@ -137,32 +214,344 @@ def string_match(query, logs, algorithm, threshold):
         # store each word and the corresponding labels in the dictionary
         label_dict[query_list[i]] = label_list[i]
         returned_label_list.append(label_dict)
+    if profile is not None:
+        profile.lap("labels")
     return returned_label_list
 
 
-def query_tagging(query_log_path, tagged_query_path, algorithm, threshold):
+def read_json_object(query_log_json, read_size=1 << 16):
     """
-    this function takes the log_path, algorithm, threshold as input, and output the labeled query to tagged_query_path
-    :param query_log_path: json file contains queries the corresponding click logs
-    :param tagged_query_path: the path of the outputted tagged query
+    parse a json file the top level of which is an object incrementally, one member at a time, so only the member being
+    parsed is kept in memory. unlike json.load, which keeps the last value of a repeated key, each occurrence of a
+    repeated key is yielded, the members are never held to find the repetitions
+    :param query_log_json: the file object of the json file
+    :param read_size: the number of characters read at a time
+    :return: a generator of (key, value) of the top level object
+    """
+    decoder = json.JSONDecoder()
+    # the unparsed text and the position of the first unparsed character
+    state = {"buffer": "", "position": 0, "eof": False}
+
+    def read_more():
+        # drop the parsed text and read at least as much as the text kept, so a long member is parsed in linear time
+        state["buffer"] = state["buffer"][state["position"]:]
+        state["position"] = 0
+        text = query_log_json.read(max(read_size, len(state["buffer"])))
+        if len(text) == 0:
+            state["eof"] = True
+        state["buffer"] = state["buffer"] + text
+
+    def next_character():
+        # skip the whitespaces and return the next character without consuming it, "" at the end of the file
+        while True:
+            buffer = state["buffer"]
+            position = state["position"]
+            while position < len(buffer) and buffer[position] in " \t\n\r":
+                position = position + 1
+            state["position"] = position
+            if position < len(buffer) or state["eof"]:
+                return buffer[position:position + 1]
+            read_more()
+
+    def expect(characters):
+        character = next_character()
+        if character == "" or character not in characters:
+            raise ValueError("expect {} at character {} of the unparsed text".format(characters, state["position"]))
+        state["position"] = state["position"] + 1
+        return character
+
+    def decode():
+        next_character()
+        while True:
+            try:
+                value, end = decoder.raw_decode(state["buffer"], state["position"])
+            except json.JSONDecodeError:
+                # the value may be cut by the end of the buffer
+                if state["eof"]:
+                    raise
+                read_more()
+                continue
+            # a number which ends the buffer may go on in the next read, e.g. 123 of 123456 or 1.5 of 1.5e+10
+            if not state["eof"] and state["buffer"][end:].strip("0123456789+-.eE") == "":
+                read_more()
+                continue
+            state["position"] = end
+            return value
+
+    def end():
+        # like json.load, only whitespaces may follow the object
+        if next_character() != "":
+            raise ValueError("extra data at character {} of the unparsed text".format(state["position"]))
+
+    expect("{")
+    if next_character() == "}":
+        expect("}")
+        end()
+        return
+    while True:
+        key = decode()
+        if not isinstance(key, str):
+            raise ValueError("expect a string key at character {} of the unparsed text".format(state["position"]))
+        expect(":")
+        value = decode()
+        yield key, value
+        if expect(",}") == "}":
+            end()
+            return
+
+
+def read_query_log(query_log_json, log_format="json"):
+    """
+    read the queries and their click logs one query at a time
+    :param query_log_json: the file object of the query and click log file
+    :param log_format: "json": one object {"query1": {...}, "query2": {...}, ...} which is parsed incrementally
+                       "jsonl": one object {"query": {...}} per line
+    :return: a generator of (query, the click log of the query), a query repeated in the file is yielded, and tagged,
+             once per occurrence
+    """
+    if log_format == "jsonl":
+        for line in query_log_json:
+            if len(line.strip()) > 0:
+                for query, logs in json.loads(line).items():
+                    yield query, logs
+    else:
+        for query, logs in read_json_object(query_log_json):
+            yield query, logs
+
+
+def write_query_log(query_log, query_log_json, log_format="json"):
+    """
+    write the queries and their click logs in the format read by read_query_log
+    :param query_log: an iterable of (query, the click log of the query)
+    :param query_log_json: the writer
+    :param log_format: "json" or "jsonl", see read_query_log
+    """
+    if log_format == "jsonl":
+        for query, logs in query_log:
+            query_log_json.write(json.dumps({query: logs}) + "\n")
+        return
+    # the members are written one by one, a query may appear more than once
+    query_log_json.write("{" + ", ".join(json.dumps(query) + ": " + json.dumps(logs) for query, logs in query_log)
+                         + "}")
+
+
+def apply_delta(query_log, delta):
+    """
+    update the click logs of the queries in place: a value with new click times replaces the click times of the value, a
+    value with 0 click times is removed, and the other values are appended to their attribute
+    :param query_log: a list of (query, {"attribute1": [{"value1": click times}, ...], ...})
+    :param delta: dict: {"query1": {"attribute1": [{"value1": click times}, ...], ...}, ...}, a query which is not in
+                  query_log is appended with its click log
+    :return: the indexes of the queries the click log of which changed, only their labels may change
+    """
+    changed = []
+    for index, (query, logs) in enumerate(query_log):
+        if query not in delta:
+            continue
+        for key, values in delta[query].items():
+            attribute_values = logs.setdefault(key, [])
+            for value in values:
+                key_name = list(value.keys())[0]
+                click_time = value[key_name]
+                occurrences = [attribute_value for attribute_value in attribute_values
+                               if list(attribute_value.keys())[0] == key_name]
+                if click_time <= 0:
+                    attribute_values[:] = [attribute_value for attribute_value in attribute_values
+                                           if list(attribute_value.keys())[0] != key_name]
+                elif len(occurrences) > 0:
+                    for attribute_value in occurrences:
+                        attribute_value[key_name] = click_time
+                else:
+                    attribute_values.append({key_name: click_time})
+        changed.append(index)
+    found = {query_log[index][0] for index in changed}
+    for query in delta:
+        if query not in found:
+            changed.append(len(query_log))
+            query_log.append((query, {key: [value for value in values if list(value.values())[0] > 0]
+                                      for key, values in delta[query].items()}))
+    return changed
+
+
+def tag_query(item):
+    """
+    tag a query with its click log in a worker process
+    :param item: (query, the click log of the query)
+    :return: the labels of the query returned by string_match, see StringMatch.ordered_labels, and its QueryProfile if a
+             Profiler is in the context
+    """
+    profiler = worker_context["profiler"]
+    profile = None if profiler is None else profiler.start_query(item[0])
+    tagged_query = string_match(item[0], item[1], worker_context["algorithm"], worker_context["threshold"],
+                                worker_context["cache"], worker_context["vectorized"], worker_context["query_cache"],
+                                worker_context["top_k"], worker_context["aggregate"], profile,
+                                worker_context["normalize"])
+    if profiler is None:
+        return ordered_labels(tagged_query)
+    if profile is not None:
+        profile.finish()
+    profiler.current = None
+    return ordered_labels(tagged_query), profile
+
+
+def tag_queries(query_log, algorithm, threshold, cache, workers=1, chunk_size=64, vectorized=False, query_cache=None,
+                top_k=None, aggregate=False, profiler=None, normalize=False):
+    """
+    tag the queries in order, the queries are sharded across a process pool when more than one worker is used
+    :param query_log: an iterable of (query, {"attribute1": [{"value1": click times}, ...], ...})
     :param algorithm: the select algorithm to calculate similarity
     :param threshold: the threshold
-    :return: write the predicted labels in the tagged_query_path
+    :param cache: the SimilarityCache, each worker process gets its own copy
+    :param workers: the number of worker processes, the queries are tagged in this process if it is 1
+    :param chunk_size: the number of queries sent to a worker at a time
+    :param vectorized: score the words with the NumPy kernel, see string_match
+    :param query_cache: a QueryCache of the repeated queries, each worker process gets its own copy
+    :param top_k: return the top_k labels of each word, see string_match
+    :param aggregate: sum the scores of each label of each word, see string_match
+    :param profiler: a Profiler of the queries, the worker processes return the profiles of their queries
+    :param normalize: split the queries and the values with StringMatch.normalize_tokens, see string_match
+    :return: a generator of (query, the labels of the query), in the order of the queries
+    """
+    if workers <= 1:
+        for query, logs in query_log:
+            if profiler is None:
+                yield query, string_match(query, logs, algorithm, threshold, cache, vectorized, query_cache, top_k,
+                                          aggregate, normalize=normalize)
+                continue
+            profile = profiler.start_query(query)
+            tagged_query = string_match(query, logs, algorithm, threshold, cache, vectorized, query_cache, top_k,
+                                        aggregate, profile, normalize)
+            profiler.finish_query(profile)
+            yield query, tagged_query
+        return
+    context = {"algorithm": algorithm, "threshold": threshold, "cache": cache, "vectorized": vectorized,
+               "query_cache": query_cache, "top_k": top_k, "aggregate": aggregate, "profiler": profiler,
+               "normalize": normalize}
+    with process_pool(workers, context) as pool:
+        for batch in batches(query_log, 4 * workers * chunk_size):
+            for (query, logs), tagged_query in zip(batch, pool.imap(tag_query, batch, chunk_size)):
+                if profiler is not None:
+                    tagged_query, profile = tagged_query
+                    profiler.queries = profiler.queries + 1
+                    profiler.finish_query(profile)
+                yield query, tagged_query
+
+
+def query_tagging(query_log_path, tagged_query_path, algorithm, threshold, cache_size=1000000, cache_path=None,
+                  workers=1, chunk_size=64, flush_every=1000, log_format="json", vectorized=False,
+                  query_cache_size=0, top_k=None, aggregate=False, profile=False, profile_trace_path=None,
+                  profile_sample_rate=1.0, output_format="text", normalize=False):
     """
+    this function takes the log_path, algorithm, threshold as input, and output the labeled query to tagged_query_path.
+    the click log is read one query at a time, so the tagging starts at once and the memory is bounded by the largest
+    click log of a single query
+    :param query_log_path: json file contains queries the corresponding click logs, "-" reads it from stdin
+    :param tagged_query_path: the path of the outputted tagged query, "-" writes the tagged queries to stdout
+    :param algorithm: the select algorithm to calculate similarity
+    :param threshold: the threshold
+    :param cache_size: the maximum number of similarity scores cached across the queries
+    :param cache_path: the similarity cache is loaded from and saved to this json file if it is not None
+    :param workers: the number of worker processes tagging the queries
+    :param chunk_size: the number of queries sent to a worker at a time
+    :param flush_every: the number of queries between two flushes of the output
+    :param log_format: "json" for a single json object or "jsonl" for one {"query": {...}} object per line
+    :param vectorized: score the words with the NumPy kernel, see string_match
+    :param query_cache_size: the maximum number of queries the labels of which are cached, 0 disables the cache. each
+                             query has its own click log so a query only hits when both are repeated, the cache is off
+                             by default since every query pays for the digest of its click log
+    :param top_k: return the top_k labels of each word, see string_match
+    :param aggregate: sum the scores of each label of each word, see string_match
+    :param profile: time the parsing of the click logs and the stages of the queries, and count the similarity calls,
+                    the visited values and the matches, a summary is printed at the end
+    :param profile_trace_path: each profiled query is written to this json lines file if it is not None
+    :param profile_sample_rate: the fraction of the queries which are profiled
+    :param output_format: "text", "jsonl", "conll" or "columnar", see StringMatch.OUTPUT_FORMATS, the scores of the
+                          labels are kept except in conll
+    :param normalize: split the queries and the values with StringMatch.normalize_tokens, see string_match
+    :return: write the predicted labels in the tagged_query_path, the summary of the Profiler if profile is True
+    """
+    # the messages go to stderr when stdout carries the tagged queries
+    message_txt = sys.stderr if tagged_query_path == "-" else sys.stdout
     # test the args
-    print("The selected similarity algorithm is: " + algorithm)
-    print("The selected threshold is: " + str(threshold))
-    # open the log file and load data
+    print("The selected similarity algorithm is: " + algorithm, file=message_txt)
+    print("The selected threshold is: " + str(threshold), file=message_txt)
+    # the profiler is off unless asked, then nothing is timed or counted
+    profiler = Profiler(profile_sample_rate, profile_trace_path) if profile else None
+    started = time.perf_counter()
+    # the similarity scores are shared by all the queries
+    cache = SimilarityCache(cache_size, similarity)
+    if cache_path is not None:
+        cache.load(cache_path)
+    if profiler is not None:
+        cache.score_function = profiler.count_calls(cache.score_function)
+    # the queries repeated with the same click log are tagged once
+    query_cache = QueryCache(query_cache_size) if query_cache_size > 0 else None
+    # the queries are parsed from the log file one by one and written through a single writer
+    with open_input(query_log_path) as query_log_json, \
+            open_output(tagged_query_path, output_format == "columnar") as tagged_query_txt:
+        query_log = read_query_log(query_log_json, log_format)
+        if profiler is not None:
+            query_log = profiler.timed(query_log, "parse")
+        tagged_queries = tag_queries(query_log, algorithm, threshold, cache, workers, chunk_size, vectorized,
+                                     query_cache, top_k, aggregate, profiler, normalize)
+        write_tagged_queries(tagged_queries, tagged_query_txt, flush_every, output_format)
+    # each worker process fills its own copy of the caches, only the caches of this process are reported and saved
+    if workers <= 1:
+        print(cache.report(), file=message_txt)
+        if query_cache is not None:
+            print(query_cache.report(), file=message_txt)
+    if cache_path is not None:
+        cache.save(cache_path)
+    if profiler is not None:
+        profiler.add_time("total", time.perf_counter() - started)
+        profiler.close()
+        print(profiler.report(), file=message_txt)
+        return profiler.summary()
+
+
+def update_tagging(query_log_path, delta_path, tagged_query_path, algorithm, threshold, updated_log_path=None,
+                   log_format="json", vectorized=False, cache_size=1000000, top_k=None, aggregate=False,
+                   output_format="text", normalize=False):
+    """
+    apply a delta of click times to the query and click log file and re-tag only the queries in the delta
+    :param query_log_path: json file contains queries the corresponding click logs
+    :param delta_path: the path of the json delta: {"query1": {"attribute1": [{"value1": click times}, ...], ...}, ...}
+    :param tagged_query_path: the path of the tagged queries written by query_tagging, it is rewritten in place
+    :param algorithm: the select algorithm to calculate similarity
+    :param threshold: the threshold
+    :param updated_log_path: the updated query and click log is written to this file if it is not None
+    :param log_format: "json" or "jsonl", the format of the query and click log files
+    :param vectorized: score the words with the NumPy kernel, see string_match
+    :param cache_size: the maximum number of similarity scores cached across the queries
+    :param top_k: return the top_k labels of each word, see string_match
+    :param aggregate: sum the scores of each label of each word, see string_match
+    :param output_format: "text" or "jsonl", the format of the tagged queries
+    :param normalize: the tagged queries were tagged with normalize
+    """
+    with open(delta_path) as delta_json:
+        delta = json.load(delta_json)
     with open(query_log_path) as query_log_json:
-        query_log = json.load(query_log_json)
-    index = 0
-    for query in query_log:
-        # print(string_match(query, logs, algorithm, threshold))
-        tagged_query = string_match(query, query_log[query], algorithm, threshold)
-        with open(tagged_query_path, "a+") as tagged_query_txt:
-            tagged_query_txt.write("query{}".format(index) + ": " + query.strip("\n") + "\n"
-                                   + "Tagged Query: " + str(tagged_query) + "\n" + "\n")
-        index = index + 1
+        query_log = list(read_query_log(query_log_json, log_format))
+    with open(tagged_query_path) as tagged_query_txt:
+        tagged_queries = list(read_tagged_queries(tagged_query_txt, output_format))
+    changed = apply_delta(query_log, delta)
+    cache = SimilarityCache(cache_size, similarity)
+    for index in changed:
+        query, logs = query_log[index]
+        tagged_query = string_match(query, logs, algorithm, threshold, cache, vectorized, top_k=top_k,
+                                    aggregate=aggregate, normalize=normalize)
+        if index < len(tagged_queries):
+            tagged_queries[index] = query, tagged_query
+        else:
+            tagged_queries.append((query, tagged_query))
+    # the tagged queries are replaced at once, a reader never sees a half-written file
+    with open(tagged_query_path + ".tmp", "w", buffering=1 << 20) as tagged_query_txt:
+        write_tagged_queries(tagged_queries, tagged_query_txt, output_format=output_format)
+    os.replace(tagged_query_path + ".tmp", tagged_query_path)
+    if updated_log_path is not None:
+        with open(updated_log_path, "w") as query_log_json:
+            write_query_log(query_log, query_log_json, log_format)
+    print("Re-tagged {} of {} queries".format(len(changed), len(tagged_queries)))
 
 
 def main():
@@ -174,19 +563,99 @@ def main():
             raise argparse.ArgumentTypeError("%r not in range [0.0, 1.0]" % (x,))
         return x
 
+    # top_k is a positive int, 0 returns all the labels
+    def top_k_int(x):
+        x = int(x)
+        if x < 0:
+            raise argparse.ArgumentTypeError("%r is negative" % (x,))
+        return x if x > 0 else None
+
+    # StringMatchClick.py update query_log_path delta_path tagged_query_path
+    if len(sys.argv) > 1 and sys.argv[1] == "update":
+        update_parser = argparse.ArgumentParser(prog="StringMatchClick.py update")
+        update_parser.add_argument("query_log_path", type=str, help="the path of the input query and click log file")
+        update_parser.add_argument("delta_path", type=str,
+                                   help="the path of the json delta of the click times: {\"query1\": {...}, ...}")
+        update_parser.add_argument("tagged_query_path", type=str,
+                                   help="the path of the tagged queries, the changed queries are re-tagged in place")
+        update_parser.add_argument("--updated_log_path", default=None, type=str,
+                                   help="write the updated query and click log to this file, it can be query_log_path")
+        update_parser.add_argument("--algorithm", default="jaro-winkler", type=str, choices=["trigram", "jaro-winkler"],
+                                   help="the algorithm the tagged queries were tagged with")
+        update_parser.add_argument("--threshold", default=0.95, type=restricted_float,
+                                   help="the threshold the tagged queries were tagged with")
+        update_parser.add_argument("--log_format", default="json", type=str, choices=["json", "jsonl"],
+                                   help="the format of the query and click log files")
+        update_parser.add_argument("--vectorized", action="store_true",
+                                   help="score the words of each query against its click log at once with NumPy")
+        update_parser.add_argument("--top_k", default=None, type=top_k_int,
+                                   help="the top_k the tagged queries were tagged with")
+        update_parser.add_argument("--aggregate", action="store_true",
+                                   help="the tagged queries were tagged with --aggregate")
+        update_parser.add_argument("--output_format", default="text", type=str, choices=["text", "jsonl"],
+                                   help="the format of the tagged queries")
+        update_parser.add_argument("--normalize", action="store_true",
+                                   help="the tagged queries were tagged with --normalize")
+        update_args = update_parser.parse_args(sys.argv[2:])
+        update_tagging(update_args.query_log_path, update_args.delta_path, update_args.tagged_query_path,
+                       update_args.algorithm, update_args.threshold, update_args.updated_log_path,
+                       update_args.log_format, update_args.vectorized, top_k=update_args.top_k,
+                       aggregate=update_args.aggregate, output_format=update_args.output_format,
+                       normalize=update_args.normalize)
+        return
+
     # command-line parsing
     parser = argparse.ArgumentParser()
-    parser.add_argument("query_log_path", type=str, help="the path of the input query and click log file")
+    parser.add_argument("query_log_path", type=str,
+                        help="the path of the input query and click log file, - reads from stdin")
     parser.add_argument("tagged_query_path", type=str,
-                        help="the path of the outputted tagged query the format of which is txt")
+                        help="the path of the outputted tagged query the format of which is txt, - writes to stdout")
     parser.add_argument("--algorithm", default="jaro-winkler", type=str, choices=["trigram", "jaro-winkler"],
                         help="select the algorithm to calculate similarity: trigram or jaro-winkler")
 
     parser.add_argument("--threshold", default=0.95, type=restricted_float,
                         help="if the similarity score of two words >= threshold, the two words are considered same")
+    parser.add_argument("--cache_size", default=1000000, type=int,
+                        help="the maximum number of similarity scores cached across the queries, 0 disables the cache")
+    parser.add_argument("--cache_path", default=None, type=str,
+                        help="load the similarity cache from this json file and save it back after tagging")
+    parser.add_argument("--workers", default=1, type=int,
+                        help="the number of worker processes tagging the queries")
+    parser.add_argument("--chunk_size", default=64, type=int,
+                        help="the number of queries sent to a worker process at a time")
+    parser.add_argument("--flush_every", default=1000, type=int,
+                        help="the number of tagged queries written between two flushes of the output")
+    parser.add_argument("--log_format", default="json", type=str, choices=["json", "jsonl"],
+                        help="json: the whole file is a json object, jsonl: each line is a json object of one query")
+    parser.add_argument("--vectorized", action="store_true",
+                        help="score the words of each query against all the words of its click log at once with NumPy")
+    parser.add_argument("--query_cache_size", default=0, type=int,
+                        help="the maximum number of queries the labels of which are cached, 0 disables the cache, " +
+                             "only useful when the same query is repeated with the same click log")
+    parser.add_argument("--top_k", default=None, type=top_k_int,
+                        help="only return the top_k labels of each word ranked by similarity score * click times, " +
+                        "the values with fewer clicks are skipped once they can't make the top_k, 0 returns all")
+    parser.add_argument("--aggregate", action="store_true",
+                        help="sum the weighted similarity scores of each label of each word instead of listing them")
+    parser.add_argument("--profile", action="store_true",
+                        help="time the parsing and the stages of the queries, count the similarity calls, the " +
+                        "visited values and the matches, and print a summary at the end")
+    parser.add_argument("--profile_trace_path", default=None, type=str,
+                        help="write each profiled query to this json lines file")
+    parser.add_argument("--profile_sample_rate", default=1.0, type=restricted_float,
+                        help="the fraction of the queries which are profiled")
+    parser.add_argument("--output_format", default="text", type=str, choices=list(OUTPUT_FORMATS),
+                        help="text: the labels of each query as a python literal, jsonl: a json object per query, " +
+                        "conll: a word and its labels per line, columnar: binary batches of flat arrays")
+    parser.add_argument("--normalize", action="store_true",
+                        help="case fold the queries and the values, split them on the whitespaces and the " +
+                        "punctuation and write the units of the numbers the same way, see StringMatch.py")
     args = parser.parse_args()
 
-    query_tagging(args.query_log_path, args.tagged_query_path, args.algorithm, args.threshold)
+    query_tagging(args.query_log_path, args.tagged_query_path, args.algorithm, args.threshold,
+                  args.cache_size, args.cache_path, args.workers, args.chunk_size, args.flush_every,
+                  args.log_format, args.vectorized, args.query_cache_size, args.top_k, args.aggregate, args.profile,
+                  args.profile_trace_path, args.profile_sample_rate, args.output_format, args.normalize)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,511 @@
+"""
+This program serves the query tagging of StringMatch.py over a local HTTP endpoint or an asyncio endpoint batching the
+concurrent queries, the click log is loaded once and reloaded when the file changes
+"""
+
+import json
+import os
+import sys
+import time
+import asyncio
+import argparse
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from StringMatch import SimilarityCache, QueryCache, load_matcher, string_match, affected_queries, labels_to_json
+
+
+def log_version(log_path):
+    """
+    identify the current content of the click log by its modification time and its size
+    :param log_path: the path of the json or compiled click log
+    :return: a version string, it changes when the file is rewritten
+    """
+    log_stat = os.stat(log_path)
+    return "{}-{}".format(log_stat.st_mtime_ns, log_stat.st_size)
+
+
+class TaggingService(object):
+    """
+    a warm Matcher of the click log shared by all the requests. the log is reloaded into a new Matcher which replaces
+    the current one only when it is complete, so the requests are never dropped or served by a half-loaded log
+    """
+
+    def __init__(self, log_path, algorithm, threshold, cache_size=1000000, exact=False, vectorized=False,
+                 query_cache_size=100000, normalize=False):
+        """
+        :param log_path: the path of the json or compiled click log
+        :param algorithm: the select algorithm to calculate similarity
+        :param threshold: the threshold
+        :param cache_size: the maximum number of similarity scores cached across the requests
+        :param exact: match the words found in the vocabulary exactly, see string_match
+        :param vectorized: score each query word against the whole vocabulary with the NumPy kernel
+        :param query_cache_size: the maximum number of queries the labels of which are cached, 0 disables the cache
+        :param normalize: split the values and the queries with StringMatch.normalize_tokens
+        """
+        self.log_path = log_path
+        self.algorithm = algorithm
+        self.threshold = threshold
+        self.exact = exact
+        self.vectorized = vectorized
+        self.normalize = normalize
+        # the similarity scores only depend on the words, the cache stays warm across the reloads
+        self.cache = SimilarityCache(cache_size)
+        # the labels of the repeated queries, they are dropped when the log is reloaded
+        self.query_cache = QueryCache(query_cache_size) if query_cache_size > 0 else None
+        # the caches and the matcher are not thread safe, the requests are tagged one at a time
+        self.lock = threading.Lock()
+        self.reloads = 0
+        self.queries = 0
+        # the number of deltas applied since the last load, they are part of the served version
+        self.deltas = 0
+        self.file_version, self.matcher = self.load()
+        self.version = self.file_version
+
+    def load(self):
+        """
+        load the click log and build the indexes of the selected algorithm
+        :return: (the version of the log, the Matcher)
+        """
+        # the version is read first, a change during the load is picked up by the next check
+        version = log_version(self.log_path)
+        matcher = load_matcher(self.log_path, self.cache, self.normalize)
+        matcher.vectorized = self.vectorized
+        matcher.warm(self.algorithm, self.exact)
+        return version, matcher
+
+    def check_reload(self):
+        """
+        reload the click log if it changed since the last load, the current Matcher is kept if the new log can't be
+        loaded, e.g. it is still being written
+        :return: True if the log is reloaded
+        """
+        try:
+            if log_version(self.log_path) == self.file_version:
+                return False
+            version, matcher = self.load()
+        except (OSError, ValueError) as error:
+            print("Failed to reload " + self.log_path + ": " + str(error), file=sys.stderr)
+            return False
+        with self.lock:
+            self.file_version, self.matcher = version, matcher
+            self.version = version
+            self.reloads = self.reloads + 1
+            self.deltas = 0
+            if self.query_cache is not None:
+                self.query_cache.clear()
+        print("Reloaded " + self.log_path + ", version " + version, file=sys.stderr)
+        return True
+
+    def watch(self, interval, stop_event):
+        """
+        check the click log periodically until stop_event is set
+        :param interval: the number of seconds between two checks
+        :param stop_event: a threading.Event
+        """
+        while not stop_event.wait(interval):
+            self.check_reload()
+
+    def apply_delta(self, delta):
+        """
+        apply a delta of the click log to the current Matcher in place, only the cached queries the labels of which may
+        change are re-tagged, the others are kept. the delta is lost when the log file changes and is reloaded
+        :param delta: dict: {"add": {"attribute1": ["value1", ...], ...}, "remove": {...}}, see Matcher.apply_delta
+        :return: dict: the number of changed values and re-tagged queries and the new version
+        """
+        with self.lock:
+            old_version = self.matcher.version()
+            changed_logs = self.matcher.apply_delta(delta)
+            retagged = 0
+            if len(changed_logs) > 0:
+                self.deltas = self.deltas + 1
+                self.version = "{}+{}".format(self.file_version, self.deltas)
+            if len(changed_logs) > 0 and self.query_cache is not None:
+                new_version = self.matcher.version()
+                entries = [(key, tagged_query) for key, tagged_query in self.query_cache.tagged_queries.items()
+                           if key[-1] == old_version]
+                affected = set(affected_queries([key[0] for key, _ in entries], changed_logs, self.algorithm,
+                                                self.threshold, self.exact, self.normalize))
+                self.query_cache.clear()
+                for index, (key, tagged_query) in enumerate(entries):
+                    if index in affected:
+                        tagged_query = string_match(key[0], self.matcher, self.algorithm, self.threshold, self.exact)
+                        retagged = retagged + 1
+                    self.query_cache.put(key[:-1] + (new_version,), tagged_query)
+            return {"changed_values": sum(len(values) for values in changed_logs.values()),
+                    "retagged_queries": retagged, "log_version": self.version}
+
+    def tag(self, queries, failures=False):
+        """
+        tag a batch of queries with the current Matcher
+        :param queries: a list of query strings
+        :param failures: if it is True, a query which fails gets its exception instead of its labels and the other
+                         queries of the batch are still tagged, otherwise the first failure is raised
+        :return: (the labels of each query returned by string_match, the version of the log which tagged them)
+        """
+        with self.lock:
+            # the queries of a batch share the similar words of their common words, the cached queries are skipped
+            uncached_queries = queries
+            if self.query_cache is not None:
+                uncached_queries = [query for query in queries
+                                    if QueryCache.key(query, self.algorithm, self.threshold, self.exact,
+                                                      self.matcher.version()) not in self.query_cache]
+            try:
+                resolved_words = self.matcher.resolve_words(uncached_queries, self.algorithm, self.threshold,
+                                                            self.exact)
+            except Exception:
+                if not failures:
+                    raise
+                # each query resolves its own words, so a word which fails only fails the queries containing it
+                resolved_words = None
+            tagged_queries = []
+            for query in queries:
+                try:
+                    tagged_queries.append(string_match(query, self.matcher, self.algorithm, self.threshold,
+                                                       self.exact, resolved_words, self.query_cache))
+                except Exception as error:
+                    if not failures:
+                        raise
+                    tagged_queries.append(error)
+            self.queries = self.queries + len(queries)
+            return tagged_queries, self.version
+
+    def status(self):
+        """
+        :return: dict: the log, its version and the counters of the service
+        """
+        with self.lock:
+            return {"log_path": self.log_path, "log_version": self.version, "algorithm": self.algorithm,
+                    "threshold": self.threshold, "reloads": self.reloads, "deltas": self.deltas,
+                    "queries": self.queries,
+                    "cache": self.cache.report(),
+                    "query_cache": self.query_cache.report() if self.query_cache is not None else None}
+
+
+def percentile(values, q):
+    """
+    the nearest-rank percentile
+    :param values: a list of numbers
+    :param q: the percentile between 0 and 100
+    :return: the smallest value which is not less than q percent of the values, 0.0 if there is no value
+    """
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, int(-(-q * len(values) // 100)) - 1))]
+
+
+def tagging_error(error):
+    """
+    :param error: the exception raised while tagging
+    :return: the message of the error response
+    """
+    return "{}: {}".format(type(error).__name__, error)
+
+
+class MicroBatcher(object):
+    """
+    an asyncio front end of a TaggingService: the queries awaited by concurrent callers are collected for at most
+    max_wait_ms or until max_batch_size queries are waiting, the batch is tagged at once in a worker thread and each
+    caller gets the labels of its own query, or its own exception if that query fails
+    """
+
+    def __init__(self, service, max_batch_size=64, max_wait_ms=2.0, stats_size=100000):
+        """
+        :param service: a TaggingService
+        :param max_batch_size: the maximum number of queries tagged in a batch
+        :param max_wait_ms: the maximum number of milliseconds the first query of a batch waits for the others
+        :param stats_size: the number of latest queries and batches the statistics are computed on
+        """
+        self.service = service
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.queue = None
+        self.latencies = deque(maxlen=stats_size)
+        self.batch_sizes = deque(maxlen=stats_size)
+        # the number of queries which failed to be tagged since the start
+        self.failures = 0
+
+    async def tag(self, query):
+        """
+        tag a query in the next batch
+        :param query: a query string
+        :return: (the labels of the query returned by string_match, the version of the log which tagged it)
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((query, future, time.perf_counter()))
+        return await future
+
+    async def run(self):
+        """
+        collect and tag the batches until cancelled
+        """
+        self.queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait_ms / 1000
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            queries = [query for query, _, _ in batch]
+            try:
+                # the event loop keeps accepting queries while the batch is tagged, a failed query doesn't fail the
+                # others of its batch
+                tagged_queries, version = await loop.run_in_executor(None, self.service.tag, queries, True)
+            except Exception as error:
+                tagged_queries, version = [error] * len(batch), None
+            finished = time.perf_counter()
+            self.batch_sizes.append(len(batch))
+            for (_, future, started), tagged_query in zip(batch, tagged_queries):
+                if isinstance(tagged_query, Exception):
+                    self.failures = self.failures + 1
+                    if not future.done():
+                        future.set_exception(tagged_query)
+                    continue
+                self.latencies.append(finished - started)
+                if not future.done():
+                    future.set_result((tagged_query, version))
+
+    def stats(self):
+        """
+        :return: dict: the latency percentiles in milliseconds and the batch sizes of the latest queries, and the
+                 number of failed queries
+        """
+        latencies = list(self.latencies)
+        batch_sizes = list(self.batch_sizes)
+        return {"queries": len(latencies), "batches": len(batch_sizes), "failures": self.failures,
+                "latency_p50_ms": percentile(latencies, 50) * 1000, "latency_p99_ms": percentile(latencies, 99) * 1000,
+                "batch_size_mean": sum(batch_sizes) / len(batch_sizes) if len(batch_sizes) > 0 else 0.0,
+                "batch_size_p50": percentile(batch_sizes, 50), "batch_size_max": max(batch_sizes, default=0)}
+
+
+async def handle_connection(batcher, reader, writer):
+    """
+    serve a connection of the asyncio endpoint, each line is a json request answered by a json line:
+    {"query": "query1"} returns {"tagged_query": [...], "log_version": ...}, {"status": true} returns the status of the
+    service and the statistics of the batches, a request which is malformed or fails to be tagged returns
+    {"error": ...}
+    :param batcher: a running MicroBatcher
+    :param reader: the asyncio.StreamReader of the connection
+    :param writer: the asyncio.StreamWriter of the connection
+    """
+    try:
+        while True:
+            line = await reader.readline()
+            if len(line) == 0:
+                break
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("the request must be a json object")
+                if "query" in request and not isinstance(request["query"], str):
+                    raise ValueError("query must be a string")
+            except (ValueError, TypeError) as error:
+                response = {"error": "bad request: " + str(error)}
+            else:
+                try:
+                    if "query" in request:
+                        tagged_query, version = await batcher.tag(request["query"])
+                        response = {"tagged_query": labels_to_json(tagged_query), "log_version": version}
+                    else:
+                        response = dict(batcher.service.status(), batching=batcher.stats())
+                except Exception as error:
+                    # the connection keeps serving the next requests
+                    response = {"error": "tagging failed: " + tagging_error(error)}
+            writer.write(json.dumps(response).encode("utf-8") + b"\n")
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_batched(service, host="127.0.0.1", port=8081, max_batch_size=64, max_wait_ms=2.0):
+    """
+    serve a TaggingService on the asyncio endpoint until cancelled
+    :param service: a TaggingService
+    :param host: the address to listen on
+    :param port: the port to listen on
+    :param max_batch_size: the maximum number of queries tagged in a batch
+    :param max_wait_ms: the maximum number of milliseconds the first query of a batch waits for the others
+    """
+    batcher = MicroBatcher(service, max_batch_size, max_wait_ms)
+    batch_task = asyncio.ensure_future(batcher.run())
+    server = await asyncio.start_server(lambda reader, writer: handle_connection(batcher, reader, writer), host, port)
+    print("Serving " + service.log_path + " on {}:{} with micro-batching".format(
+        *server.sockets[0].getsockname()[:2]), file=sys.stderr)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batch_task.cancel()
+
+
+class TaggingRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /tag {"queries": ["query1", ...]} returns {"tagged_queries": [...], "log_version": ...}
+    POST /delta {"add": {...}, "remove": {...}} updates the click log in place, see TaggingService.apply_delta
+    GET /status returns the status of the service
+    a malformed request returns 400 and a batch which fails to be tagged returns 500, both with {"error": ...}
+    """
+
+    def do_GET(self):
+        if self.path != "/status":
+            self.send_json(404, {"error": "unknown path " + self.path})
+            return
+        self.send_json(200, self.server.service.status())
+
+    def do_POST(self):
+        if self.path not in ("/tag", "/delta"):
+            self.send_json(404, {"error": "unknown path " + self.path})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if not isinstance(body, dict):
+                raise ValueError("the request must be a json object")
+            if self.path == "/delta":
+                self.send_json(200, self.server.service.apply_delta(body))
+                return
+            queries = body["queries"]
+            if not isinstance(queries, list) or not all(isinstance(query, str) for query in queries):
+                raise ValueError("queries must be a list of strings")
+        except (ValueError, KeyError, TypeError) as error:
+            self.send_json(400, {"error": "bad request: " + str(error)})
+            return
+        try:
+            tagged_queries, version = self.server.service.tag(queries)
+        except Exception as error:
+            # e.g. pyjarowinkler rejects the empty word of a query ending with a space
+            self.send_json(500, {"error": "tagging failed: " + tagging_error(error)})
+            return
+        self.send_json(200, {"tagged_queries": [labels_to_json(tagged_query) for tagged_query in tagged_queries],
+                             "log_version": version})
+
+    def send_json(self, code, response):
+        """
+        write a json response
+        :param code: the http status code
+        :param response: a json serializable object
+        """
+        data = json.dumps(response).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # the requests are not logged, the server sits in the search request path
+        pass
+
+
+def make_server(service, host="127.0.0.1", port=8080):
+    """
+    create the http server of a TaggingService, each connection is handled by its own thread
+    :param service: a TaggingService
+    :param host: the address to listen on
+    :param port: the port to listen on, 0 picks a free port
+    :return: a ThreadingHTTPServer, the service is server.service
+    """
+    server = ThreadingHTTPServer((host, port), TaggingRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+
+def serve(log_path, algorithm, threshold, host="127.0.0.1", port=8080, cache_size=1000000, exact=False,
+          vectorized=False, reload_interval=1.0, batching=False, max_batch_size=64, max_wait_ms=2.0,
+          query_cache_size=100000, normalize=False):
+    """
+    load the click log and serve the tagging until interrupted
+    :param log_path: click log path, the json click log or the one compiled by StringMatch.py compile
+    :param algorithm: the select algorithm to calculate similarity
+    :param threshold: the threshold
+    :param host: the address to listen on
+    :param port: the port to listen on
+    :param cache_size: the maximum number of similarity scores cached across the requests
+    :param exact: match the words found in the vocabulary exactly, see string_match
+    :param vectorized: score each query word against the whole vocabulary with the NumPy kernel
+    :param reload_interval: the number of seconds between two checks of the click log, 0 disables the reload
+    :param batching: serve the asyncio endpoint batching the concurrent queries instead of the http endpoint
+    :param max_batch_size: the maximum number of queries tagged in a batch
+    :param max_wait_ms: the maximum number of milliseconds the first query of a batch waits for the others
+    :param query_cache_size: the maximum number of queries the labels of which are cached, 0 disables the cache
+    :param normalize: split the values and the queries with StringMatch.normalize_tokens
+    """
+    service = TaggingService(log_path, algorithm, threshold, cache_size, exact, vectorized, query_cache_size,
+                             normalize)
+    stop_event = threading.Event()
+    if reload_interval > 0:
+        threading.Thread(target=service.watch, args=(reload_interval, stop_event), daemon=True).start()
+    if batching:
+        try:
+            asyncio.run(serve_batched(service, host, port, max_batch_size, max_wait_ms))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stop_event.set()
+        return
+    server = make_server(service, host, port)
+    print("Serving " + log_path + " on http://{}:{}".format(*server.server_address[:2]), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_event.set()
+        server.server_close()
+
+
+def main():
+
+    # the threshold is float between [0.0, 1]
+    def restricted_float(x):
+        x = float(x)
+        if x < 0.0 or x > 1.0:
+            raise argparse.ArgumentTypeError("%r not in range [0.0, 1.0]" % (x,))
+        return x
+
+    # command-line parsing
+    parser = argparse.ArgumentParser()
+    parser.add_argument("log_path", type=str, help="the path of click log, json or compiled by StringMatch.py compile")
+    parser.add_argument("--host", default="127.0.0.1", type=str, help="the address to listen on")
+    parser.add_argument("--port", default=8080, type=int, help="the port to listen on")
+    parser.add_argument("--algorithm", default="jaro-winkler", type=str, choices=["trigram", "jaro-winkler"],
+                        help="select the algorithm to calculate similarity: trigram or jaro-winkler")
+    parser.add_argument("--threshold", default=0.95, type=restricted_float,
+                        help="if the similarity score of two words >= threshold, the two words are considered same")
+    parser.add_argument("--cache_size", default=1000000, type=int,
+                        help="the maximum number of similarity scores cached across the requests, 0 disables the cache")
+    parser.add_argument("--exact", action="store_true",
+                        help="a query word found in the click log only matches itself, see StringMatch.py --exact")
+    parser.add_argument("--vectorized", action="store_true",
+                        help="score each query word against the whole vocabulary at once with NumPy")
+    parser.add_argument("--reload_interval", default=1.0, type=float,
+                        help="the number of seconds between two checks of the click log, 0 disables the reload")
+    parser.add_argument("--batching", action="store_true",
+                        help="serve json lines over tcp, the concurrent queries are tagged in micro-batches")
+    parser.add_argument("--max_batch_size", default=64, type=int,
+                        help="the maximum number of queries tagged in a micro-batch")
+    parser.add_argument("--max_wait_ms", default=2.0, type=float,
+                        help="the maximum number of milliseconds a query waits for the others of its micro-batch")
+    parser.add_argument("--query_cache_size", default=100000, type=int,
+                        help="the maximum number of queries the labels of which are cached, 0 disables the cache")
+    parser.add_argument("--normalize", action="store_true",
+                        help="case fold the queries and the values, split them on the whitespaces and the " +
+                        "punctuation and write the units of the numbers the same way, see StringMatch.py")
+    args = parser.parse_args()
+
+    serve(args.log_path, args.algorithm, args.threshold, args.host, args.port, args.cache_size, args.exact,
+          args.vectorized, args.reload_interval, args.batching, args.max_batch_size, args.max_wait_ms,
+          args.query_cache_size, args.normalize)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+check the incremental parsing of the query and click log of StringMatchClick.py against json.loads, and the early stop
+of top_k against the ranking of all the labels
+"""
+import io
+import json
+
+import pytest
+
+from StringMatch import QueryProfile
+from StringMatchBenchmark import generate_dataset
+from StringMatchClick import read_json_object, read_query_log, string_match
+
+DOCUMENTS = [
+    '{"a": 123456789, "b": 2}',
+    '{"a": -1.5e+10, "b": 0.000123, "c": 1E5}',
+    '  {  }  ',
+    '{"q": {"Brand": [{"apple": 12}, {"samsung": 3}]}, "q2": {}}',
+    '{"t": true, "f": false, "n": null, "s": "a \\"quoted\\" \\\\ string \\u00e9", "x": [1, [2, [3]], {"y": 4}]}',
+    '\n{\n  "apple watch": {"Brand": [{"apple": 1000}]},\n  "65in tv": {"ScreenSize": [{"65\\"": 7}]}\n}\n',
+    '{"über": "café", "long": "' + "x" * 200 + '", "n": 98765432109876543210}',
+]
+
+
+@pytest.mark.parametrize("read_size", range(1, 65))
+def test_read_json_object_matches_json_loads(read_size):
+    for document in DOCUMENTS:
+        assert list(read_json_object(io.StringIO(document), read_size)) == list(json.loads(document).items())
+
+
+@pytest.mark.parametrize("read_size", range(1, 65))
+def test_read_json_object_yields_each_repeated_key(read_size):
+    members = list(read_json_object(io.StringIO('{"q": 1, "r": 2, "q": 30}'), read_size))
+    assert members == [("q", 1), ("r", 2), ("q", 30)]
+
+
+@pytest.mark.parametrize("read_size", range(1, 65))
+@pytest.mark.parametrize("document", ['{"a": 1} x', '{"a": 1}}', '{} {}', '{"a": 1, "b": 2}\n,', '{"a": 12',
+                                      '{"a" 1}', '{1: 2}', '', '{"a": 1,}'])
+def test_read_json_object_rejects_what_json_loads_rejects(read_size, document):
+    with pytest.raises(ValueError):
+        json.loads(document)
+    with pytest.raises(ValueError):
+        list(read_json_object(io.StringIO(document), read_size))
+
+
+@pytest.fixture(scope="module")
+def query_log(tmp_path_factory):
+    paths = generate_dataset(str(tmp_path_factory.mktemp("synthetic")), 1)
+    with open(paths["query_log_path"]) as query_log_json:
+        query_log = list(read_query_log(query_log_json, "jsonl"))
+    # the weak match of "appl" is beaten by the value visited after it, which has fewer clicks
+    return query_log + [("apple", {"Brand": [{"appl": 100}], "Category": [{"apple": 80}, {"apple watch": 10}]})]
+
+
+@pytest.mark.parametrize("top_k", [1, 2, 5])
+def test_top_k_is_the_truncated_ranking_of_all_the_labels(query_log, top_k):
+    visited = {"top_k": 0, "all": 0}
+    for query, logs in query_log:
+        profiles = {"top_k": QueryProfile(query), "all": QueryProfile(query)}
+        tagged = string_match(query, logs, "trigram", 0.5, top_k=top_k, profile=profiles["top_k"])
+        # no word gets this many labels, all of them are ranked without stopping early
+        ranked = string_match(query, logs, "trigram", 0.5, top_k=10 ** 9, profile=profiles["all"])
+        assert tagged == [{word: labels[:top_k]} for word_labels in ranked for word, labels in word_labels.items()]
+        for name, profile in profiles.items():
+            visited[name] = visited[name] + profile.counters.get("values", 0)
+    # the early stop skipped some values
+    assert visited["top_k"] < visited["all"]
@@ -0,0 +1,88 @@
+"""
+round-trip a small fixture of tagged queries through each writer of OUTPUT_FORMATS: the labels of StringMatch are sets,
+the labels of StringMatchClick are lists of "O" and {label: score}
+"""
+import io
+import math
+import os
+
+import pytest
+
+from StringMatch import label_scores, labels_to_json, read_tagged_columns, read_tagged_queries, write_tagged_queries
+
+TAGGED_QUERIES = [
+    ("apple watch\n", [{"apple": {"B-Brand", "B-Category"}}, {"watch": {"I-Category"}}]),
+    ("65in tv", [{"65in": {"B-ScreenSize"}}, {"tv": {"O"}}]),
+    ("café crème", [{"café": {"O"}}, {"crème": {"O"}}]),
+    ("samsung tv samsung", [{"samsung": [{"B-Brand": 812.5}, {"B-Category": 3.0}]}, {"tv": ["O"]},
+                            {"samsung": [{"B-Brand": 812.5}]}]),
+    ("", [{"": {"O"}}]),
+]
+
+
+def write(output_format, binary=False):
+    tagged_query_txt = io.BytesIO() if binary else io.StringIO()
+    # two queries per batch, the last batch is not full
+    write_tagged_queries(iter(TAGGED_QUERIES), tagged_query_txt, 2, output_format)
+    return tagged_query_txt.getvalue()
+
+
+def expected_words(with_scores):
+    """
+    :param with_scores: keep the scores of the labels, else only the label names in their first order
+    :return: [(query, [(word, the labels of the word)])] of TAGGED_QUERIES
+    """
+    expected = []
+    for query, tagged_query in TAGGED_QUERIES:
+        words = []
+        for word_labels in tagged_query:
+            for word, labels in word_labels.items():
+                pairs = label_scores(labels)
+                words.append((word, pairs if with_scores else list(dict.fromkeys(label for label, _ in pairs))))
+        expected.append((query.strip("\n"), words))
+    return expected
+
+
+@pytest.mark.parametrize("output_format", ["text", "jsonl"])
+def test_read_tagged_queries_round_trip(output_format):
+    read = list(read_tagged_queries(io.StringIO(write(output_format)), output_format))
+    if output_format == "jsonl":
+        expected = [(query.strip("\n"), labels_to_json(tagged_query)) for query, tagged_query in TAGGED_QUERIES]
+    else:
+        expected = [(query.strip("\n"), tagged_query) for query, tagged_query in TAGGED_QUERIES]
+    assert read == expected
+
+
+def test_conll_round_trip():
+    queries = []
+    words = []
+    for line in write("conll").split("\n")[:-1]:
+        if line == "":
+            queries.append(words)
+            words = []
+        else:
+            word, labels = line.split("\t")
+            words.append((word, labels.split("|")))
+    assert words == []
+    assert queries == [query_words for _, query_words in expected_words(False)]
+
+
+def test_columnar_round_trip(tmp_path):
+    path = os.path.join(str(tmp_path), "tagged.bin")
+    with open(path, "wb") as tagged_query_file:
+        tagged_query_file.write(write("columnar", binary=True))
+    read = []
+    batch_sizes = []
+    for batch in read_tagged_columns(path):
+        batch_sizes.append(len(batch["queries"]))
+        for i in range(len(batch["queries"])):
+            words = []
+            for j in range(batch["word_rows"][i], batch["word_rows"][i + 1]):
+                pairs = []
+                for k in range(batch["label_rows"][j], batch["label_rows"][j + 1]):
+                    score = float(batch["label_scores"][k])
+                    pairs.append((batch["labels"][batch["label_ids"][k]], None if math.isnan(score) else score))
+                words.append((batch["words"][j], pairs))
+            read.append((batch["queries"][i], words))
+    assert batch_sizes == [2, 2, 1]
+    assert read == expected_words(True)
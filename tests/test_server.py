@@ -0,0 +1,184 @@
+"""
+drive StringMatchServer with loopback clients: the http endpoint and the asyncio micro-batching endpoint on 127.0.0.1
+and a free port
+"""
+import asyncio
+import contextlib
+import inspect
+import json
+import os
+import shutil
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+from pyjarowinkler import distance
+
+from StringMatch import Matcher, labels_to_json, string_match
+from StringMatchServer import MicroBatcher, TaggingService, handle_connection, make_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+QUERIES = ["apple watch", "samsung tv", "iphone 7 plus", "apple watch"]
+
+jaro_winkler = pytest.mark.skipif("winkler" not in inspect.signature(distance.get_jaro_distance).parameters,
+                                  reason="similarity_score needs the pyjarowinkler 1.x api")
+
+
+@pytest.fixture
+def log_path(tmp_path):
+    path = os.path.join(str(tmp_path), "click_log.json")
+    shutil.copy(os.path.join(ROOT, "bestbuy_click_log.json"), path)
+    return path
+
+
+@contextlib.contextmanager
+def serving(service):
+    """
+    :param service: a TaggingService
+    :return: a context manager of the http server of the service, running on a free port of 127.0.0.1
+    """
+    http_server = make_server(service, port=0)
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    try:
+        yield http_server
+    finally:
+        http_server.shutdown()
+        http_server.server_close()
+
+
+@pytest.fixture
+def server(log_path):
+    with serving(TaggingService(log_path, "trigram", 0.8)) as http_server:
+        yield http_server
+
+
+def request(server, path, body=None):
+    """
+    :param server: the running http server
+    :param path: the path of the request, a GET without a body and a POST with one
+    :param body: the bytes or the json object of a POST
+    :return: (the status code, the json response)
+    """
+    url = "http://127.0.0.1:{}{}".format(server.server_address[1], path)
+    if body is not None and not isinstance(body, bytes):
+        body = json.dumps(body).encode("utf-8")
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, body), timeout=30) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as error:
+        return error.code, json.loads(error.read())
+
+
+def expected_tags(log_path, queries):
+    with open(log_path) as logs_json:
+        matcher = Matcher(json.load(logs_json))
+    return [labels_to_json(string_match(query, matcher, "trigram", 0.8)) for query in queries]
+
+
+@pytest.mark.parametrize("delta", [{"add": ["x"]}, {"add": {"Brand": "nest"}}, {"remove": {"Brand": [1]}},
+                                   {"add": {"Brand": ["zyxel nest"]}, "remove": None}, {"replace": {}}])
+def test_malformed_delta_is_a_bad_request_and_changes_nothing(server, log_path, delta):
+    service = server.service
+    _, tagged = request(server, "/tag", {"queries": QUERIES})
+    version = service.version
+    code, response = request(server, "/delta", delta)
+    assert code == 400 and response["error"].startswith("bad request")
+    assert service.version == version and service.deltas == 0
+    # the valid part of the delta is not applied either
+    assert service.matcher.find_values("Brand", "zyxel nest") == []
+    assert request(server, "/tag", {"queries": QUERIES}) == (200, tagged)
+    assert tagged["tagged_queries"] == expected_tags(log_path, QUERIES)
+
+
+def test_tag_request(server, log_path):
+    code, response = request(server, "/tag", {"queries": QUERIES})
+    assert code == 200
+    assert response["tagged_queries"] == expected_tags(log_path, QUERIES)
+    assert response["log_version"] == server.service.version
+    assert request(server, "/status")[1]["queries"] == len(QUERIES)
+
+
+@pytest.mark.parametrize("body", [b"{bad", b"[]", {"query": "apple"}, {"queries": "apple watch"}, {"queries": [1]}])
+def test_bad_request(server, body):
+    code, response = request(server, "/tag", body)
+    assert code == 400 and response["error"].startswith("bad request")
+    # the server keeps serving
+    assert request(server, "/tag", {"queries": ["apple watch"]})[0] == 200
+
+
+@jaro_winkler
+def test_failed_tagging_is_a_server_error(log_path):
+    # pyjarowinkler rejects the empty word after the trailing space
+    with serving(TaggingService(log_path, "jaro-winkler", 0.8)) as http_server:
+        code, response = request(http_server, "/tag", {"queries": ["apple watch", "tv "]})
+        assert code == 500 and "JaroDistanceException" in response["error"]
+        assert request(http_server, "/tag", {"queries": ["apple watch"]})[0] == 200
+
+
+def test_unknown_path(server):
+    assert request(server, "/nothing")[0] == 404
+
+
+def test_reload(server, log_path):
+    service = server.service
+    old_version = service.version
+    with open(log_path) as logs_json:
+        logs = json.load(logs_json)
+    logs["Brand"].append("zyxel")
+    with open(log_path, "w") as logs_json:
+        json.dump(logs, logs_json)
+    assert service.check_reload()
+    code, response = request(server, "/tag", {"queries": ["zyxel router"]})
+    assert code == 200 and response["log_version"] != old_version
+    assert response["tagged_queries"] == expected_tags(log_path, ["zyxel router"])
+    assert "B-Brand" in response["tagged_queries"][0][0]["zyxel"]
+    status = request(server, "/status")[1]
+    assert status["reloads"] == 1 and status["log_version"] == response["log_version"]
+    # an unchanged log is not reloaded
+    assert not service.check_reload()
+
+
+def test_micro_batch_isolates_the_answers_and_the_failures(log_path):
+    service = TaggingService(log_path, "trigram", 0.8)
+    similar_words = service.matcher.similar_words
+
+    def failing_similar_words(word, algorithm, threshold):
+        if word == "boom":
+            raise RuntimeError("cannot tag boom")
+        return similar_words(word, algorithm, threshold)
+    service.matcher.similar_words = failing_similar_words
+    queries = QUERIES + ["boom box", "lg monitor"]
+
+    async def ask(port, line):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(line + b"\n")
+        await writer.drain()
+        response = json.loads(await reader.readline())
+        writer.close()
+        return response
+
+    async def main():
+        # a long wait so the concurrent queries share a batch
+        batcher = MicroBatcher(service, max_batch_size=64, max_wait_ms=200)
+        batch_task = asyncio.ensure_future(batcher.run())
+        tcp_server = await asyncio.start_server(lambda reader, writer: handle_connection(batcher, reader, writer),
+                                                "127.0.0.1", 0)
+        port = tcp_server.sockets[0].getsockname()[1]
+        try:
+            responses = await asyncio.gather(*[ask(port, json.dumps({"query": query}).encode("utf-8"))
+                                               for query in queries])
+            status = await ask(port, b'{"status": true}')
+        finally:
+            tcp_server.close()
+            batch_task.cancel()
+        return responses, status
+
+    responses, status = asyncio.run(main())
+    failed = queries.index("boom box")
+    assert responses[failed] == {"error": "tagging failed: RuntimeError: cannot tag boom"}
+    tagged = [response["tagged_query"] for index, response in enumerate(responses) if index != failed]
+    assert tagged == expected_tags(log_path, [query for index, query in enumerate(queries) if index != failed])
+    batching = status["batching"]
+    assert batching["failures"] == 1 and batching["queries"] == len(queries) - 1
+    assert batching["batch_size_max"] == len(queries)
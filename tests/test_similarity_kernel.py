@@ -0,0 +1,57 @@
+"""
+pin the scores of the NumPy kernel to similarity_score, including the words containing "*" which pyjarowinkler uses to
+mark the matched characters and the scores which pyjarowinkler rounds half to even
+"""
+import inspect
+import random
+
+import numpy as np
+import pytest
+from pyjarowinkler import distance
+
+from StringMatch import SimilarityKernel, similarity_matrix, similarity_score
+
+jaro_winkler = pytest.mark.skipif("winkler" not in inspect.signature(distance.get_jaro_distance).parameters,
+                                  reason="similarity_score needs the pyjarowinkler 1.x api")
+
+WORDS = ["iphone", "iPhone", "phone", "apple", "Apple", "appl", "laptop", "lap*op", "*", "**", "a*", "*a", "ab*cd",
+         "abcd*", "a", "ab", "TV", "tv", "Samsung", "samsung*", "55in", "4k", "4K*", "headphones", "head*phones",
+         # the scores of these pairs are halves of a hundredth, pyjarowinkler rounds them to even
+         "dBbdea", "dAdba", "A**c"]
+
+
+def random_words(count, seed):
+    """
+    :param count: the number of words
+    :param seed: the seed of the random words
+    :return: short random words over a small alphabet with "*", so many pairs share characters and prefixes
+    """
+    rng = random.Random(seed)
+    return ["".join(rng.choice("abAB*c") for _ in range(rng.randint(1, 7))) for _ in range(count)]
+
+
+VOCABULARY = WORDS + random_words(300, 0)
+QUERY_WORDS = WORDS + random_words(60, 1)
+
+
+def exact_scores(query_words, vocabulary, algorithm):
+    return np.array([[similarity_score(w1, w2, algorithm) for w2 in vocabulary] for w1 in query_words])
+
+
+@pytest.mark.parametrize("algorithm", ["trigram", pytest.param("jaro-winkler", marks=jaro_winkler)])
+def test_similarity_matrix_matches_similarity_score(algorithm):
+    matrix = similarity_matrix(QUERY_WORDS, VOCABULARY, algorithm)
+    assert np.array_equal(matrix, exact_scores(QUERY_WORDS, VOCABULARY, algorithm))
+
+
+@jaro_winkler
+@pytest.mark.parametrize("threshold", [0.6, 0.8, 0.95])
+def test_jaro_winkler_threshold_keeps_every_similar_word(threshold):
+    kernel = SimilarityKernel(VOCABULARY, block_size=64)
+    exact = exact_scores(QUERY_WORDS, VOCABULARY, "jaro-winkler")
+    for row, word in enumerate(QUERY_WORDS):
+        scores = kernel.scores(word, "jaro-winkler", threshold)
+        # the words reaching the threshold are scored exactly, the pruned ones score 0
+        similar = exact[row] >= threshold
+        assert np.array_equal(scores[similar], exact[row][similar])
+        assert np.all((scores == exact[row]) | (scores == 0))
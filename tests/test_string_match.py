@@ -0,0 +1,147 @@
+"""
+compare the tagged bestbuy queries with the golden files tagged by the original StringMatch.py, with and without the
+profiler, and the output of the worker processes with the serial output, and check the query cache, the spans of
+longest_value_match and the click log written back by a normalized Matcher
+"""
+import ast
+import inspect
+import os
+import subprocess
+import sys
+
+import pytest
+from pyjarowinkler import distance
+
+from StringMatch import Matcher, QueryCache, query_tagging, string_match
+from StringMatchBenchmark import generate_dataset
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GOLDEN = os.path.join(ROOT, "tests", "golden")
+
+# the jaro-winkler labels were computed with the winkler keyword of pyjarowinkler 1.x
+jaro_winkler = pytest.mark.skipif("winkler" not in inspect.signature(distance.get_jaro_distance).parameters,
+                                  reason="the golden files need the pyjarowinkler 1.x api")
+
+
+def tag(tmp_path, algorithm, *options, threshold="0.8", script="StringMatch.py", inputs=None):
+    """
+    tag the queries in a new process, the order of the labels of a word is the iteration order of a set
+    :param tmp_path: the directory of the tagged queries
+    :param algorithm: the name of the algorithm to calculate the similarity
+    :param options: the other command line arguments
+    :param threshold: the threshold to determine whether two word are similar or not
+    :param script: StringMatch.py or StringMatchClick.py
+    :param inputs: the input paths of the script, bestbuy_query.txt and bestbuy_click_log.json by default
+    :return: the bytes of the tagged queries
+    """
+    if inputs is None:
+        inputs = [os.path.join(ROOT, "bestbuy_query.txt"), os.path.join(ROOT, "bestbuy_click_log.json")]
+    # the tagged queries are appended to the output file, each run writes a new one
+    tagged_query_path = os.path.join(str(tmp_path), "tagged_{}.txt".format(len(os.listdir(str(tmp_path)))))
+    env = dict(os.environ, PYTHONHASHSEED="0")
+    subprocess.run([sys.executable, os.path.join(ROOT, script)] + inputs + [tagged_query_path, "--algorithm",
+                                                                            algorithm, "--threshold", threshold]
+                   + list(options), check=True, env=env, cwd=str(tmp_path), stdout=subprocess.DEVNULL)
+    with open(tagged_query_path, "rb") as tagged_query_txt:
+        return tagged_query_txt.read()
+
+
+def golden(algorithm):
+    with open(os.path.join(GOLDEN, "bestbuy_query_tagged_{}_0.8.txt".format(algorithm)), "rb") as golden_txt:
+        return golden_txt.read()
+
+
+@pytest.mark.parametrize("options", [(), ("--query_cache_size", "0"), ("--vectorized",)])
+@pytest.mark.parametrize("algorithm", ["trigram", pytest.param("jaro-winkler", marks=jaro_winkler)])
+def test_bestbuy_queries_match_golden(tmp_path, algorithm, options):
+    assert tag(tmp_path, algorithm, *options) == golden(algorithm)
+
+
+@pytest.mark.parametrize("algorithm, threshold", [("trigram", "0.2"),
+                                                  pytest.param("jaro-winkler", "0.7", marks=jaro_winkler)])
+def test_workers_match_serial_output(tmp_path, algorithm, threshold):
+    # the labels come back from the worker processes pickled, they must print in the order of the serial run
+    serial = tag(tmp_path, algorithm, threshold=threshold)
+    assert tag(tmp_path, algorithm, "--workers", "2", "--chunk_size", "16", threshold=threshold) == serial
+
+
+def test_profiler_is_off_by_default(tmp_path, capsys):
+    tagged_query_path = os.path.join(str(tmp_path), "tagged.txt")
+    assert query_tagging(os.path.join(ROOT, "bestbuy_query.txt"), os.path.join(ROOT, "bestbuy_click_log.json"),
+                         tagged_query_path, "trigram", 0.8) is None
+    assert "Profile:" not in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("options", [(), ("--profile_sample_rate", "0.5"), ("--workers", "2")])
+def test_profile_leaves_the_tags_unchanged(tmp_path, options):
+    trace_path = os.path.join(str(tmp_path), "trace.jsonl")
+    assert tag(tmp_path, "trigram", "--profile", "--profile_trace_path", trace_path, *options) == golden("trigram")
+    with open(trace_path) as trace_jsonl:
+        assert len(trace_jsonl.readlines()) > 0
+
+
+def test_click_workers_match_serial_output(tmp_path):
+    paths = generate_dataset(str(tmp_path), 1)
+    inputs = [paths["query_log_path"]]
+    serial = tag(tmp_path, "trigram", "--log_format", "jsonl", threshold="0.5", script="StringMatchClick.py",
+                 inputs=inputs)
+    assert tag(tmp_path, "trigram", "--log_format", "jsonl", "--workers", "2", threshold="0.5",
+               script="StringMatchClick.py", inputs=inputs) == serial
+
+
+def test_normalized_matcher_writes_the_original_values():
+    logs = {"Brand": ["Apple", "Nest-Cam", "LG"], "ScreenSize": ["65in", "55 Inches"], "Feature": ["!!!"]}
+    matcher = Matcher(logs, normalize=True)
+    assert matcher.to_logs() == logs
+    matcher.apply_delta({"add": {"Brand": ["Sony TV"]}, "remove": {"Brand": ["lg"], "ScreenSize": ["55 inch"]}})
+    assert matcher.to_logs() == {"Brand": ["Apple", "Nest-Cam", "Sony TV"], "ScreenSize": ["65in"],
+                                 "Feature": ["!!!"]}
+
+
+def test_query_cache_hits_until_the_click_log_changes():
+    matcher = Matcher({"Brand": ["apple", "samsung"], "Category": ["watch"]})
+    query_cache = QueryCache()
+    tagged = string_match("zyxel watch\n", matcher, "trigram", 0.8, query_cache=query_cache)
+    # the trailing newline is not part of the key, a hit returns the cached labels themselves
+    assert string_match("zyxel watch", matcher, "trigram", 0.8, query_cache=query_cache) is tagged
+    assert (query_cache.hits, query_cache.misses) == (1, 1)
+    assert string_match("zyxel watch", matcher, "trigram", 0.5, query_cache=query_cache) is not tagged
+    version = matcher.version()
+    matcher.apply_delta({"add": {"Brand": ["zyxel"]}})
+    assert matcher.version() != version
+    # the labels cached for the old click log are not returned for the new one
+    assert string_match("zyxel watch", matcher, "trigram", 0.8, query_cache=query_cache) == [
+        {"zyxel": {"B-Brand"}}, {"watch": {"B-Category"}}]
+    assert tagged == [{"zyxel": {"O"}}, {"watch": {"B-Category"}}]
+    assert (query_cache.hits, query_cache.misses) == (1, 3)
+
+
+SPANS_QUERY = [{"abd": {"B-PD"}}, {"blue": {"B-CO", "I-PD"}}, {"tv": {"B-CO", "B-BR"}}, {"appl": {"I-BR"}},
+               {"ab": {"B-PD"}}, {"bl": {"B-CO", "I-PD"}}]
+SPANS = [{"abd": {"B-PD"}}, {"blue": {"I-PD"}}, {"tv": {"B-BR"}}, {"appl": {"I-BR"}}, {"ab": {"B-PD"}},
+         {"bl": {"I-PD"}}]
+
+
+@pytest.mark.parametrize("seed", ["0", "1", "2", "3"])
+def test_longest_value_match_spans(seed):
+    # "blue" and "bl" continue the values begun by "abd" and "ab" whatever the iteration order of the label sets, the
+    # old scan depended on that order and began new values at them under some hash seeds
+    code = "from StringMatch import longest_value_match; print(longest_value_match({!r}, {!r}))".format(
+        SPANS_QUERY, {"B-CO", "B-BR", "B-PD", "I-BR", "I-PD"})
+    resolved = subprocess.run([sys.executable, "-c", code], check=True, cwd=ROOT, stdout=subprocess.PIPE,
+                              env=dict(os.environ, PYTHONHASHSEED=seed)).stdout
+    assert ast.literal_eval(resolved.decode("utf-8")) == SPANS
+
+
+@jaro_winkler
+def test_string_match_spans_jaro_winkler():
+    logs = {"CO": ["tv tvs", "tv tvs", "tv", "blue"], "PT": ["tvs x appl"],
+            "PD": ["watch", "abc blue", "watch x watch"], "BR": ["tv apple", "x bcd appl", "appl appl abc"]}
+    assert string_match("abd blue tv appl ab bl", logs, "jaro-winkler", 0.8) == SPANS
+
+
+def test_string_match_spans_trigram():
+    logs = {"CO": ["x apple", "abc blue", "abd apple"], "PT": ["red tvs", "ab apple", "apple"],
+            "PD": ["bl tvs bcd", "appl", "abc abc", "appl apple"], "BR": ["bl"]}
+    assert string_match("blue tvs apple appl x appl", logs, "trigram", 0.5) == [
+        {"blue": {"O"}}, {"tvs": {"O"}}, {"apple": {"B-PD"}}, {"appl": {"I-PD"}}, {"x": {"B-CO"}}, {"appl": {"I-CO"}}]